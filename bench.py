@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# Benchmark for the randomizer pipeline. Every preset generates the same seeds in a scratch tree
+# and reports end to end and per phase throughput. Results are appended to a JSON lines file
+# tagged with the current commit so runs can be compared between commits.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from rando import MAKE_JOBS, PTCGRando, Profiler, build_seed, is_tool, make_reference, make_work_tree, parse_seeds
+
+SEEDS = list(range(1, 21))
+
+# Option overrides applied on top of the PTCGRando defaults
+PRESETS = {
+    "default": {},
+    "prize_full_random": {"exclude_prize": False, "prize_full_random": True},
+    "booster_random_amount": {"exclude_boosters": False, "booster_original_amount": False},
+    "exclude_none": {
+        "exclude_prize": False,
+        "exclude_decks": False,
+        "exclude_music": False,
+        "exclude_boosters": False,
+        "exclude_npcs": False,
+    },
+    "exclude_all": {
+        "exclude_prize": True,
+        "exclude_decks": True,
+        "exclude_music": True,
+        "exclude_boosters": True,
+        "exclude_npcs": True,
+    },
+}
+
+
+def git_commit():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except FileNotFoundError:
+        return None
+    if rev.returncode != 0:
+        return None
+    return rev.stdout.strip()
+
+
+# Generates seeds with one preset, returns its timings
+def run_preset(name, seeds, build=False, template_cache=None, make_jobs=MAKE_JOBS):
+    ptcg = PTCGRando()
+    ptcg.make_jobs = make_jobs
+    for option, value in PRESETS[name].items():
+        setattr(ptcg, option, value)
+
+    ptcg.profiler = Profiler()
+    with ptcg.phase("load_data"):
+        ptcg.load_data("data/data.json", "data/cards.json", "data/npc_names.json")
+    with ptcg.phase("load_templates"):
+        ptcg.load_templates(template_cache)
+
+    with tempfile.TemporaryDirectory(prefix="ptcg_bench_") as work_dir:
+        if build:
+            make_work_tree(work_dir)
+        else:
+            for path in PTCGRando.OUTPUTS:
+                os.makedirs(os.path.join(work_dir, os.path.dirname(path)), exist_ok=True)
+        ptcg.output_dir = work_dir
+
+        success = True
+        start = time.perf_counter()
+        for seed in seeds:
+            with ptcg.phase("seed"):
+                if build:
+                    success = build_seed(ptcg, seed, work_dir, work_dir, copy_rom=False) and success
+                else:
+                    ptcg.seed = seed
+                    ptcg.randomize()
+        elapsed = time.perf_counter() - start
+
+    phases = {}
+    for phase, stats in ptcg.profiler.phases.items():
+        phases[phase] = dict(stats)
+        phases[phase]["per_sec"] = stats["calls"] / stats["wall"] if stats["wall"] > 0 else None
+
+    return {
+        "success": success,
+        "seconds": elapsed,
+        "seeds_per_sec": len(seeds) / elapsed if elapsed > 0 else None,
+        "phases": phases,
+    }
+
+
+def run(seeds, presets, build=False, template_cache=None, make_jobs=MAKE_JOBS):
+    result = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "build": build,
+        "make_jobs": make_jobs,
+        "seeds": seeds,
+        "presets": {},
+    }
+
+    for name in presets:
+        result["presets"][name] = run_preset(name, seeds, build, template_cache, make_jobs)
+        print("{:<24} {:8.2f} seeds/sec".format(name, result["presets"][name]["seeds_per_sec"]))
+
+    return result
+
+
+def load_results(results_file):
+    results = []
+    if os.path.exists(results_file):
+        with open(results_file, "r", encoding="utf8") as file:
+            for line in file:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+
+# Last stored run of a commit with the same build mode
+def find_result(results, commit, build):
+    for result in reversed(results):
+        if result["commit"] is not None and result["commit"].startswith(commit) and result["build"] == build:
+            return result
+    return None
+
+
+def print_comparison(base, result):
+    print("compared to {} ({})".format(base["commit"], base["time"]))
+    for name, preset in result["presets"].items():
+        if name not in base["presets"]:
+            continue
+        before = base["presets"][name]
+        print("{:<24} {:8.2f} -> {:8.2f} seeds/sec ({:+.1f}%)".format(
+            name,
+            before["seeds_per_sec"],
+            preset["seeds_per_sec"],
+            (preset["seeds_per_sec"] / before["seeds_per_sec"] - 1) * 100,
+        ))
+
+        for phase, stats in preset["phases"].items():
+            old = before["phases"].get(phase)
+            if old is None or not old["wall"] or phase.startswith("load_"):
+                continue
+            print("    {:<34} {:9.3f}ms -> {:9.3f}ms".format(
+                phase, old["wall"] / old["calls"] * 1000, stats["wall"] / stats["calls"] * 1000
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pokemon TCG randomizer benchmark")
+    parser.add_argument("--seeds", type=parse_seeds, default=SEEDS, help="seeds generated by every preset, e.g. 1-20")
+    parser.add_argument("--presets", default=",".join(PRESETS), help="comma separated presets: " + ", ".join(PRESETS))
+    parser.add_argument("--build", action="store_true", help="also run make and lipx for every seed")
+    parser.add_argument("--make-jobs", type=int, default=MAKE_JOBS, help="make jobs of every seed build")
+    parser.add_argument("--results", default="bench_results.jsonl", help="file the results are appended to")
+    parser.add_argument("--compare", metavar="COMMIT", help="compare with the last stored run of this commit")
+    parser.add_argument("--no-save", action="store_true", help="don't append the results to the results file")
+    parser.add_argument("--template-cache", help="file caching the compiled templates, templates are compiled every run if omitted")
+    args = parser.parse_args()
+
+    # Data, templates and sources are relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    presets = args.presets.split(",")
+    for name in presets:
+        if name not in PRESETS:
+            parser.error("unknown preset: {}".format(name))
+
+    if args.build:
+        if not is_tool("make"):
+            parser.error("--build needs make and the RGBDS tools on PATH")
+
+        # Reference build so the tools and shared objects exist before the scratch trees link to them
+        if not make_reference():
+            sys.exit(1)
+
+    result = run(args.seeds, presets, args.build, args.template_cache, args.make_jobs)
+
+    if args.compare is not None:
+        base = find_result(load_results(args.results), args.compare, args.build)
+        if base is None:
+            print("No stored run for commit {}".format(args.compare))
+        else:
+            print_comparison(base, result)
+
+    if not args.no_save:
+        with open(args.results, "a", encoding="utf8") as file:
+            file.write(json.dumps(result, sort_keys=True) + "\n")
+
+    if not all(preset["success"] for preset in result["presets"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
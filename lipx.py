@@ -1,355 +1,1309 @@
-#!/usr/bin/env python3
-
-# https://github.com/kylon/Lipx
-# GNU GPL 3
-
-import collections
-import os
-import struct
-import sys
-
-VERSION = '1.2'
-_ntuple_diskusage = collections.namedtuple('usage', 'total used free')
-
-
-def disk_usage(path):
-    try:
-        st = os.statvfs(path)
-        free = st.f_bavail * st.f_frsize
-        total = st.f_blocks * st.f_frsize
-        used = (st.f_blocks - st.f_bfree) * st.f_frsize
-
-        return _ntuple_diskusage(total, used, free)
-    except:
-        return _ntuple_diskusage(999999999, 0, 999999999)
-
-
-def usage():
-    this = os.path.basename(sys.argv[0])
-
-    print('\nLipx v' + VERSION + ' - Linux IPS tool\n\n' +
-           'Usage:\n\n' +
-           '    == Apply patch\n' +
-           '    ' + this + ' -a originalFile patchFile\n\n' +
-           '    == Create a copy and apply the patch - original is untouched\n' +
-           '    ' + this + ' -ab originalFile patchFile [outputFile]\n\n' +
-           '    == Create IPS patch\n' +
-           '    ' + this + ' -c originalFile modifiedFile [outputFile]\n\n' +
-           'Arguments:\n' +
-           '    [] optional argument\n')
-
-    sys.exit(1)
-
-
-# Helper function to get an integer from a bytearray (Big endian)
-def get_uint16(data, index):
-    return int((data[index] << 8) | data[index + 1])
-
-
-# Helper function to get an integer from a bytearray (Big endian)
-def get_uint24(data, index):
-    return int((data[index] << 16) | (data[index + 1] << 8) | data[index + 2])
-
-
-class IPS(object):
-    def __init__(self, cmd, original_file, modified_file, patch_file):
-        # 16MB Max size of an IPS file - 3byte int
-        self.FILE_LIMIT = 0x1000000
-
-        # Max size of an individual record - 2 byte int
-        self.RECORD_LIMIT = 0xFFFF
-
-        # IPS file header 'PATCH'
-        self.PATCH_ASCII = b"\x50\x41\x54\x43\x48"
-
-        # IPS file footer 'EOF'
-        self.EOF_ASCII = b"\x45\x4f\x46"
-
-        # Lipx Command
-        self.cmd = cmd
-
-        # Unmodified ROM File
-        self.original_file = original_file
-
-        # Modified ROM File
-        self.modified_file = modified_file
-
-        # IPS Patch File
-        self.patch_file = patch_file
-
-        # Accounting variables
-        self.curr_offset = 0
-        self.record_count = 0
-        self.patch_size = 0
-
-    def __call__(self):
-        ret = False
-
-        print('### Lipx v' + VERSION + ' - Linux IPS Tool ###\n')
-
-        self._setup_files()
-
-        if self.cmd == '-c':
-            ret = self.create_ips()
-        elif self.cmd == '-a' or self.cmd == '-ab':
-            ret = self.apply_ips()
-
-        if not ret:
-            print('> Error - __call__ error!')
-            sys.exit(1)
-
-        return True
-
-    def __check_disk_space(self, file_to_check):
-        directory = os.path.dirname(os.path.abspath(file_to_check))
-
-        if directory == '':
-            directory = '.'
-
-        if disk_usage(directory).free <= self.FILE_LIMIT:
-            return False
-
-        return True
-
-    def _setup_files(self):
-        if not self.__check_disk_space(self.patch_file):
-            print('> Not enough space on this disk!\n')
-            sys.exit(1)
-
-        if self.cmd == '-ab':
-            if not self.__check_disk_space(self.original_file):
-                print('> Not enough space on this disk!\n')
-                sys.exit(1)
-
-        # File object containing the original (base) ROM data
-        try:
-            self.original_data = open(self.original_file, 'rb').read()
-        except:
-            print("> Cannot read %s" % self.original_file + '.\n')
-            sys.exit(1)
-
-        # File object containing the modified ROM data (To create IPS patch)
-        if self.cmd != '-a' and self.cmd != '-ab':
-            try:
-                self.modified_data = open(self.modified_file, 'rb').read()
-            except:
-                print("> Cannot read %s" % self.modified_file + '.\n')
-                sys.exit(1)
-
-        # File object containing the IPS patch
-        try:
-            if self.cmd == '-a' or self.cmd == '-ab':
-                self.patch_file_obj = bytearray(open(self.patch_file, 'rb').read())
-            else:
-                self.patch_file_obj = open(self.patch_file, 'wb')
-        except:
-            print("> Cannot read %s" % self.patch_file + '.\n')
-            sys.exit(1)
-
-        if self.cmd != '-a' and self.cmd != '-ab':
-            # The IPS file format has a size limit of 16MB
-            if len(self.modified_data) > self.FILE_LIMIT:
-                print('File is too large! ( Max 16MB )\nThe patch could be broken!')
-
-        return True
-
-    def write_record(self, record_data, overide_size=0):
-        """
-        Method that takes relevant data and write an IPS record (non-RLE encoded)
-
-        Format looks like (all integers in BIG endian):
-        [OFFSET into file : 3bytes][SIZE of record : 2bytes][BYTES : SIZEbytes]
-        """
-
-        # Encode record's absolute offset into the original ROM,
-        # (IPS file format uses big endian 3-byte int, hence a truncated long, yuck!)
-        self.patch_file_obj.write(struct.pack(">L", self.curr_offset)[1:])
-
-        # Encode size of record
-        if not overide_size:
-            self.patch_file_obj.write(struct.pack(">H", len(record_data)))
-        else:
-            self.patch_file_obj.write(struct.pack(">H", overide_size))
-
-        # Write the data
-        self.patch_file_obj.write(record_data)
-
-        # Do some accounting
-        self.record_count += 1
-        self.patch_size += len(record_data) + 5
-
-    def apply_ips(self):
-        a = 5
-        file_to_patch = self.original_file
-
-        if self.cmd == '-ab':
-            try:
-                org_file_cont = bytearray(open(file_to_patch, 'rb').read())
-                open(self.modified_file, 'wb').write(org_file_cont)
-            except:
-                print('> Error - Cannot create %s' % self.modified_file)
-                sys.exit(1)
-
-            file_to_patch = self.modified_file
-
-        patched_file = bytearray(open(file_to_patch, 'rb').read())
-
-        while a < len(self.patch_file_obj) - 3:
-            # Get offset
-            offset = get_uint24(self.patch_file_obj, a)
-            a += 3
-
-            # Get packet size
-            size = get_uint16(self.patch_file_obj, a)
-            a += 2
-
-            if size == 0:
-                # Get RLE repeat count
-                rle_size = get_uint16(self.patch_file_obj, a)
-                a += 2
-
-                # Grow the patched file if needed
-                if (offset + rle_size) > len(patched_file):
-                    patched_file += bytearray((offset + rle_size) - len(patched_file))
-
-                # Get repeat byte
-                repeat = self.patch_file_obj[a]
-                a += 1
-
-                for x in range(rle_size):
-                    try:
-                        patched_file[offset + x] = repeat
-                    except:
-                        print('> Error - Unable to parse the patch!')
-                        sys.exit(1)
-            else:
-                # Grow the patched file if needed
-                if (offset + size) > len(patched_file):
-                    patched_file += bytearray((offset + size) - len(patched_file))
-
-                # Normal packet, copy from patch to file
-                for x in range(size):
-                    try:
-                        patched_file[offset + x] = self.patch_file_obj[a]
-                        a += 1
-                    except:
-                        print('> Error - Unable to parse the patch!')
-                        sys.exit(1)
-
-        try:
-            # Write modified data
-            open(file_to_patch, 'wb').write(patched_file)
-        except:
-            print('> Error - Cannot write to file!')
-            sys.exit(1)
-
-        print('> Success - Patch applied to %s' % file_to_patch)
-
-        return True
-
-    def create_ips(self):
-        record_begun = False
-        record = bytearray()
-        original_data_len = len(self.original_data)
-
-        # IPS file header
-        self.patch_file_obj.write(self.PATCH_ASCII)
-        self.patch_size += len(self.PATCH_ASCII)
-
-        # Write the IPS record(s).
-        # Format looks like (all integers in BIG endian):
-        # [OFFSET into file : 3bytes][SIZE of record : 2bytes][BYTES : SIZEbytes]
-
-        # Diff bytes between the new ROM and the base ROM, 1 byte at a time
-        for pos in range(len(self.modified_data)):
-            if not record_begun:
-
-                if original_data_len <= pos or self.modified_data[pos] != self.original_data[pos]:
-                    record_begun = True
-                    record = bytearray()
-
-                    # From http://romhack.wikia.com/wiki/IPS in 'Caveats' section:
-                    #
-                    # The number 0x454f46 looks like "EOF" in ASCII, which is why a patch record must never begin at
-                    # offset 0x454f46. If your program generates a patch record at offset 0x454f46, then you have a bug,
-                    # because IPS patchers will read the "EOF". One possible workaround is to start at offset 0x454f45
-                    # and include the extra byte in the patch.
-                    #
-                    # If a patch provides multiple values for the same byte in the patched file, then the IPS patcher
-                    # may use any of these overlapped values. Also, if the patch extends the size of the patched file,
-                    # but does not provide values for all bytes in the extended area, then the IPS patcher may fill the
-                    # gaps with any values. A better IPS file provides no such overlapped values and no such gaps,
-                    # though this is not a requirement of the IPS format.
-                    if pos == self.EOF_ASCII:
-                        record.append(self.modified_data[pos - 1])
-
-                    # Add the byte from the new ROM at address 'a' to the record
-                    record.append(self.modified_data[pos])
-
-                    # Save the absolute offset for this record
-                    self.curr_offset = pos
-
-                    # Corner case - should never hit for real ROMs
-                    # If we're at the last address, close the record and write to the patch file
-                    if pos == len(self.modified_data) - 1:
-                        record_begun = False
-                        self.write_record(record, overide_size=0x01)
-            else:
-                # Records have a max size of 0xFFFF as the size header is a short
-                # Check our current position and if we at the max size end the record and start a new one
-                if len(record) == self.RECORD_LIMIT - 1:
-                    print("Truncating overlong record: %s %s" % (len(record), hex(len(record))))
-
-                    record_begun = False
-                    record.append(self.modified_data[pos])
-                    self.write_record(record)
-
-                # Append diff data to the record
-                elif (original_data_len <= pos or
-                              self.modified_data[pos] != self.original_data[pos]) and pos != len(self.modified_data) - 1:
-                    # Continue Record
-                    record.append(self.modified_data[pos])
-
-                # END OF RECORD
-                # If we're at the last address of the new ROM, the bytes at the address are identical in both ROMs,
-                # or the base ROM  is longer than the address we are at in the modified ROM close the record
-                else:
-                    record_begun = False
-                    self.write_record(record)
-
-        # Add the footer to the IPS file and flush the data to disk & close entire IPS file
-        self.patch_file_obj.write(self.EOF_ASCII)
-        self.patch_size += len(self.EOF_ASCII)
-        self.patch_file_obj.close()
-
-        print("> Success - Patch file: %s" % self.patch_file)
-
-        return True
-
-
-if __name__ == '__main__':
-    arg_len = len(sys.argv)
-
-    if arg_len < 4:
-        usage()
-
-    if sys.argv[1] == '-a':
-        ips = IPS(sys.argv[1], sys.argv[2], '', sys.argv[3])
-        ips()
-
-    elif sys.argv[1] == '-ab':
-        # sys.argv[4] is user supplied _patched_ file name.
-        # Keep the compability - note the order of arguments.
-        patched_file_name = 'Patched_'+sys.argv[2] if arg_len == 4 else sys.argv[4]
-        ips = IPS(sys.argv[1], sys.argv[2], patched_file_name, sys.argv[3])
-        ips()
-
-    elif sys.argv[1] == '-c':
-        patch_file_name = sys.argv[3]+'.ips' if arg_len == 4 else sys.argv[4]
-        ips = IPS(sys.argv[1], sys.argv[2], sys.argv[3], patch_file_name)
-        ips()
-
-    else:
-        usage()
-
+#!/usr/bin/env python3
+
+# https://github.com/kylon/Lipx
+# GNU GPL 3
+
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+
+VERSION = '1.2'
+_ntuple_diskusage = collections.namedtuple('usage', 'total used free')
+
+
+def disk_usage(path):
+    try:
+        st = os.statvfs(path)
+        free = st.f_bavail * st.f_frsize
+        total = st.f_blocks * st.f_frsize
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+
+        return _ntuple_diskusage(total, used, free)
+    except:
+        return _ntuple_diskusage(999999999, 0, 999999999)
+
+
+def usage():
+    this = os.path.basename(sys.argv[0])
+
+    print('\nLipx v' + VERSION + ' - Linux IPS tool\n\n' +
+           'Usage:\n\n' +
+           '    == Apply patches, in order in one pass\n' +
+           '    ' + this + ' -a originalFile patchFile [patchFile ...]\n\n' +
+           '    == Apply patches in place through mmap, without loading the whole file\n' +
+           '    ' + this + ' -am originalFile patchFile [patchFile ...]\n\n' +
+           '    == Create a copy and apply the patch - original is untouched\n' +
+           '    ' + this + ' -ab originalFile patchFile [outputFile]\n\n' +
+           '    == Create IPS patch\n' +
+           '    ' + this + ' -c originalFile modifiedFile [outputFile]\n\n' +
+           '    == Create BPS patch, with checksums and copies of moved data\n' +
+           '    ' + this + ' -cb originalFile modifiedFile [outputFile]\n\n' +
+           '    == Create IPS (-cm) or BPS (-cmb) patches of many ROMs or directories of ROMs\n' +
+           '    == in parallel, with a manifest.json of their sizes and record counts\n' +
+           '    ' + this + ' -cm originalFile outputDir modifiedFile [modifiedFile ...]\n\n' +
+           '    == Compose IPS patches into one normalized patch, later patches win where they overlap\n' +
+           '    ' + this + ' -j outputFile patchFile [patchFile ...]\n\n' +
+           'Patches are applied as IPS or BPS from their header.\n\n' +
+           'Arguments:\n' +
+           '    [] optional argument\n' +
+           '    --no-check-sha1 apply patches without checking the base ROM against rom.sha1 next to ' + this + '\n')
+
+    sys.exit(1)
+
+
+# Matches a non zero byte
+_NON_ZERO = re.compile(b'[^\x00]')
+
+
+def diff_runs(original_data, modified_data, block_size=0x10000):
+    """
+    Yield the (start, end) ranges of modified_data where every byte differs from original_data
+
+    Blocks are compared whole first, only differing ones are scanned. Inside a block the differing
+    bytes are the non zero bytes of original XOR modified, found with C level searches. Bytes past
+    the end of original_data all differ.
+    """
+    common_len = min(len(original_data), len(modified_data))
+    run_start = None
+
+    for block_start in range(0, common_len, block_size):
+        block_end = min(block_start + block_size, common_len)
+        modified_block = modified_data[block_start:block_end]
+        original_block = original_data[block_start:block_end]
+
+        if modified_block == original_block:
+            if run_start is not None:
+                yield run_start, block_start
+                run_start = None
+            continue
+
+        length = block_end - block_start
+        xor = (int.from_bytes(modified_block, 'big') ^ int.from_bytes(original_block, 'big')).to_bytes(length, 'big')
+
+        i = 0
+        while i < length:
+            if run_start is None:
+                match = _NON_ZERO.search(xor, i)
+                if match is None:
+                    break
+                i = match.start()
+                run_start = block_start + i
+            else:
+                i = xor.find(b'\x00', i)
+                if i == -1:
+                    break
+                yield run_start, block_start + i
+                run_start = None
+
+    if len(modified_data) > common_len:
+        if run_start is None:
+            run_start = common_len
+        yield run_start, len(modified_data)
+    elif run_start is not None:
+        yield run_start, common_len
+
+
+def merge_runs(runs, max_gap):
+    """
+    Yield the (start, end) runs joined whenever at most max_gap equal bytes separate them
+
+    Rewriting a few unchanged bytes is cheaper than the header of another record.
+    """
+    merged = None
+
+    for start, end in runs:
+        if merged is not None and start - merged[1] <= max_gap:
+            merged = (merged[0], end)
+            continue
+        if merged is not None:
+            yield merged
+        merged = (start, end)
+
+    if merged is not None:
+        yield merged
+
+
+# Matches a run of bytes marked as written when composing patches
+_WRITTEN = re.compile(b'\x01+')
+
+
+# Matches a byte repeated at least 4 times, the shortest run an RLE record can ever save bytes on
+_REPEATED = re.compile(b'(.)\\1{3,}', re.DOTALL)
+
+
+# 16MB Max size of an IPS file - 3byte int
+FILE_LIMIT = 0x1000000
+
+# Max size of an individual record - 2 byte int
+RECORD_LIMIT = 0xFFFF
+
+# A record can't start at this offset, patchers would read it as the 'EOF' footer
+EOF_OFFSET = 0x454F46
+
+# IPS file header 'PATCH'
+PATCH_ASCII = b"\x50\x41\x54\x43\x48"
+
+# IPS file footer 'EOF'
+EOF_ASCII = b"\x45\x4f\x46"
+
+
+class IPSError(Exception):
+    """Raised by the library functions for patches that can't be created or applied."""
+
+
+# Helper function to get an integer from a bytearray (Big endian)
+def get_uint16(data, index):
+    return int((data[index] << 8) | data[index + 1])
+
+
+# Helper function to get an integer from a bytearray (Big endian)
+def get_uint24(data, index):
+    return int((data[index] << 16) | (data[index + 1] << 8) | data[index + 2])
+
+
+class IPS(object):
+    def __init__(self, cmd, original_file, modified_file, patch_file):
+        # Bytes taken by the header of a record and by a whole RLE record
+        self.RECORD_HEADER = 5
+        self.RLE_RECORD = 8
+
+        # Equal bytes written with the surrounding changes rather than starting a new record
+        self.MERGE_GAP = self.RECORD_HEADER - 1
+
+        # Bytes compared at once when diffing, identical blocks are skipped with a single comparison
+        self.DIFF_BLOCK = 0x10000
+
+        # Lipx Command
+        self.cmd = cmd
+
+        # Unmodified ROM File
+        self.original_file = original_file
+
+        # Modified ROM File
+        self.modified_file = modified_file
+
+        # IPS Patch File
+        self.patch_file = patch_file
+
+        # Patch Files applied in order, or composed with -j
+        self.patch_files = [patch_file]
+
+        # Modified ROM Files or directories diffed with -cm and -cmb, patch_file is the output directory
+        self.modified_files = [modified_file]
+
+        # Accounting variables, taken from the IPSWriter once a patch is written
+        self.record_count = 0
+        self.patch_size = 0
+
+        # Check the base ROM against SHA1_FILE before applying patches, whenever it exists
+        self.check_sha1 = os.path.exists(SHA1_FILE)
+
+        # Progress messages, off when used as a library
+        self.verbose = True
+
+    def __call__(self):
+        ret = False
+
+        print('### Lipx v' + VERSION + ' - Linux IPS Tool ###\n')
+
+        self._setup_files()
+
+        if self.cmd == '-c':
+            ret = self.create_ips()
+        elif self.cmd == '-cb':
+            ret = self.create_bps()
+        elif self.cmd == '-a' or self.cmd == '-ab' or self.cmd == '-am':
+            ret = self.apply_ips()
+        elif self.cmd == '-j':
+            ret = self.compose_ips()
+        elif self.cmd == '-cm' or self.cmd == '-cmb':
+            ret = self.create_many()
+
+        if not ret:
+            print('> Error - __call__ error!')
+            sys.exit(1)
+
+        return True
+
+    def __check_disk_space(self, file_to_check):
+        directory = os.path.dirname(os.path.abspath(file_to_check))
+
+        if directory == '':
+            directory = '.'
+
+        if disk_usage(directory).free <= FILE_LIMIT:
+            return False
+
+        return True
+
+    def _setup_files(self):
+        if not self.__check_disk_space(self.patch_file):
+            print('> Not enough space on this disk!\n')
+            sys.exit(1)
+
+        if self.cmd == '-ab':
+            if not self.__check_disk_space(self.original_file):
+                print('> Not enough space on this disk!\n')
+                sys.exit(1)
+
+        # File object containing the original (base) ROM data, patched through mmap with -am
+        try:
+            if self.cmd == '-am':
+                open(self.original_file, 'r+b').close()
+            elif self.cmd != '-j':
+                self.original_data = open(self.original_file, 'rb').read()
+        except:
+            print("> Cannot read %s" % self.original_file + '.\n')
+            sys.exit(1)
+
+        # File object containing the modified ROM data (To create IPS or BPS patch)
+        if self.cmd == '-c' or self.cmd == '-cb':
+            try:
+                self.modified_data = open(self.modified_file, 'rb').read()
+            except:
+                print("> Cannot read %s" % self.modified_file + '.\n')
+                sys.exit(1)
+
+        # Output directory of the batch patches
+        if self.cmd == '-cm' or self.cmd == '-cmb':
+            try:
+                os.makedirs(self.patch_file, exist_ok=True)
+            except OSError:
+                print("> Cannot create %s" % self.patch_file + '.\n')
+                sys.exit(1)
+            return True
+
+        # Patches to apply or compose, read in order
+        self.patch_file_objs = []
+        if self.cmd != '-c' and self.cmd != '-cb':
+            for patch_file in self.patch_files:
+                try:
+                    self.patch_file_objs.append(open(patch_file, 'rb').read())
+                except:
+                    print("> Cannot read %s" % patch_file + '.\n')
+                    sys.exit(1)
+
+        # File object containing the IPS patch
+        try:
+            if self.cmd == '-c' or self.cmd == '-cb' or self.cmd == '-j':
+                self.patch_file_obj = open(self.patch_file, 'wb')
+            else:
+                self.patch_file_obj = self.patch_file_objs[0]
+        except:
+            print("> Cannot read %s" % self.patch_file + '.\n')
+            sys.exit(1)
+
+        return True
+
+    def apply_ips(self):
+        file_to_patch = self.original_file
+
+        if self.cmd == '-ab':
+            file_to_patch = self.modified_file
+
+        # Refuse a wrong base ROM before anything gets patched
+        if self.check_sha1:
+            try:
+                self._verify_base()
+            except IPSError as error:
+                print('> Error - %s' % error)
+                sys.exit(1)
+            except OSError:
+                print("> Cannot read %s" % SHA1_FILE + '.\n')
+                sys.exit(1)
+
+        patched_file = None
+        try:
+            if self.cmd == '-am' and not any(patch[:4] == BPS.BPS_ASCII for patch in self.patch_file_objs):
+                self._patch_in_place(file_to_patch)
+            else:
+                # BPS targets are built from the whole source, -am reads and rewrites the file
+                if self.cmd == '-am':
+                    self.original_data = open(file_to_patch, 'rb').read()
+                patched_file = self._patch_all(bytearray(self.original_data))
+        except BPSError as error:
+            print('> Error - %s' % error)
+            sys.exit(1)
+        except IPSError:
+            print('> Error - Unable to parse the patch!')
+            sys.exit(1)
+        except OSError:
+            print('> Error - Cannot write to file!')
+            sys.exit(1)
+
+        if patched_file is not None:
+            try:
+                # Write modified data
+                open(file_to_patch, 'wb').write(patched_file)
+            except:
+                print('> Error - Cannot write to file!')
+                sys.exit(1)
+
+        print('> Success - Patch applied to %s' % file_to_patch)
+
+        return True
+
+    def _verify_base(self):
+        """
+        Check the ROM to patch against SHA1_FILE, -am hashes the file through mmap
+        """
+        if self.cmd != '-am':
+            verify_base(self.original_data)
+            return
+
+        with open(self.original_file, 'rb') as original_file:
+            if os.fstat(original_file.fileno()).st_size == 0:
+                verify_base(b'')
+                return
+
+            with mmap.mmap(original_file.fileno(), 0, access=mmap.ACCESS_READ) as original_map:
+                verify_base(original_map)
+
+    def _records(self, patch_data=None):
+        """
+        Parse the loaded patch, or patch_data, into a list of (offset, data) records
+
+        Normal records data is a memoryview into the patch, RLE records are expanded to their
+        repeated byte. The whole patch is checked before anything gets patched.
+        """
+        records = []
+
+        for record in IPSReader(self.patch_file_obj if patch_data is None else patch_data):
+            if len(record) == 3:
+                offset, rle_size, repeat = record
+                records.append((offset, bytes((repeat,)) * rle_size))
+            else:
+                records.append(record)
+
+        return records
+
+    def _patch(self, patched_file, patch_data=None):
+        """
+        Apply the records of the loaded patch, or patch_data, to the patched_file bytearray, growing it as needed
+        """
+        for offset, data in self._records(patch_data):
+            end = offset + len(data)
+
+            # Grow the patched file if needed
+            if end > len(patched_file):
+                patched_file += bytearray(end - len(patched_file))
+
+            patched_file[offset:end] = data
+
+        return patched_file
+
+    def _patch_all(self, patched_file):
+        """
+        Apply every loaded patch in order to the patched_file bytearray, returns the patched bytearray
+
+        IPS patches write into the same bytearray, BPS patches build a new one from it.
+        """
+        for patch_data in self.patch_file_objs:
+            if patch_data[:4] == BPS.BPS_ASCII:
+                patched_file = BPS(patched_file).apply(patch_data)
+            else:
+                patched_file = self._patch(patched_file, patch_data)
+
+        return patched_file
+
+    def _patch_in_place(self, file_to_patch):
+        """
+        Apply the records of every loaded IPS patch in order to file_to_patch through mmap, only
+        the pages written to are loaded
+        """
+        # Every patch is checked before anything gets patched
+        records = []
+        for patch_data in self.patch_file_objs:
+            records += self._records(patch_data)
+        patched_size = max([offset + len(data) for offset, data in records] + [0])
+
+        with open(file_to_patch, 'r+b') as patched_file:
+            # Grow the patched file if needed
+            if patched_size > os.fstat(patched_file.fileno()).st_size:
+                patched_file.truncate(patched_size)
+
+            if not records:
+                return
+
+            with mmap.mmap(patched_file.fileno(), 0) as patched_map:
+                for offset, data in records:
+                    patched_map[offset:offset + len(data)] = data
+
+    def create_ips(self):
+        try:
+            self._diff()
+        except IPSError as error:
+            print('> Error - %s' % error)
+            sys.exit(1)
+
+        self.patch_file_obj.close()
+
+        print("> Success - Patch file: %s" % self.patch_file)
+
+        return True
+
+    def compose_ips(self):
+        try:
+            self._compose()
+        except IPSError as error:
+            print('> Error - %s' % error)
+            sys.exit(1)
+
+        self.patch_file_obj.close()
+
+        print("> Success - Patch file: %s" % self.patch_file)
+
+        return True
+
+    def _compose(self):
+        """
+        Write the single IPS patch equivalent to the loaded patches applied in order to patch_file_obj
+
+        Later patches win where records overlap. The result has sorted records without overlaps,
+        written by the same encoder as created patches.
+        """
+        patches = []
+        for patch_data in self.patch_file_objs:
+            if patch_data[:4] == BPS.BPS_ASCII:
+                raise IPSError('BPS patches depend on the base ROM and can\'t be composed')
+            patches.append(self._records(patch_data))
+
+        # Every written byte ends up in modified_data, covered marks which ones were written
+        size = max([offset + len(data) for records in patches for offset, data in records] + [0])
+        if size > FILE_LIMIT:
+            raise IPSError('File is too large! ( Max 16MB )')
+
+        modified_data = bytearray(size)
+        covered = bytearray(size)
+        for records in patches:
+            for offset, data in records:
+                modified_data[offset:offset + len(data)] = data
+                covered[offset:offset + len(data)] = b'\x01' * len(data)
+
+        self.modified_data = bytes(modified_data)
+        self.writer = IPSWriter(self.patch_file_obj)
+
+        # Bytes no patch writes can't be merged into the records, they depend on the ROM
+        for match in _WRITTEN.finditer(covered):
+            # A record can't be moved back over the 'EOF' offset when the byte before it is unknown
+            if match.start() == EOF_OFFSET:
+                raise IPSError('A record starts at offset 0x454f46 ("EOF")')
+            self._write_span(*match.span())
+
+        self._close_writer()
+
+    def create_many(self):
+        try:
+            modified_files = rom_files(self.modified_files, self.original_file)
+            manifest = create_patches(self.original_data, modified_files, self.patch_file, self.cmd == '-cmb')
+        except (IPSError, OSError) as error:
+            print('> Error - %s' % error)
+            sys.exit(1)
+
+        failed = [entry for entry in manifest['patches'] if 'error' in entry]
+        for entry in failed:
+            print('> Error - %s: %s' % (entry['rom'], entry['error']))
+        if failed:
+            sys.exit(1)
+
+        print("> Success - %d patches, %d bytes, manifest: %s" % (
+            len(manifest['patches']), manifest['total_size'], os.path.join(self.patch_file, MANIFEST_FILE)
+        ))
+
+        return True
+
+    def create_bps(self):
+        try:
+            self.patch_file_obj.write(BPS(self.original_data).create(self.modified_data))
+        except OSError:
+            print('> Error - Cannot write to file!')
+            sys.exit(1)
+
+        self.patch_file_obj.close()
+
+        print("> Success - Patch file: %s" % self.patch_file)
+
+        return True
+
+    def _diff(self):
+        """
+        Write the patch turning original_data into modified_data to patch_file_obj
+        """
+        modified_data_len = len(self.modified_data)
+
+        # The IPS file format has a size limit of 16MB, offsets past it can't be encoded
+        if modified_data_len > FILE_LIMIT:
+            raise IPSError('File is too large! ( Max 16MB )')
+
+        # Write the IPS record(s), see IPSWriter for the format
+        self.writer = IPSWriter(self.patch_file_obj)
+        for start, end in merge_runs(diff_runs(self.original_data, self.modified_data, self.DIFF_BLOCK), self.MERGE_GAP):
+            self._write_span(start, end)
+
+        self._close_writer()
+
+    def _close_writer(self):
+        # Add the footer to the IPS file and do some accounting
+        self.writer.close()
+        self.record_count = self.writer.record_count
+        self.patch_size = self.writer.patch_size
+
+    def _write_span(self, start, end):
+        """
+        Write the records for modified_data[start:end], repeated byte runs become RLE records when smaller
+        """
+        literal_start = start
+
+        for match in _REPEATED.finditer(self.modified_data, start, end):
+            run_start, run_end = match.span()
+
+            # Bytes saved by an RLE record instead of keeping the run in the literal record. Cutting the
+            # literal record costs a header for the bytes after the run, but a run starting it saves one
+            saved = (run_end - run_start) - self.RLE_RECORD
+            if run_end < end:
+                saved -= self.RECORD_HEADER
+            if run_start == literal_start:
+                saved += self.RECORD_HEADER
+
+            if saved > 0:
+                self._write_literal(literal_start, run_start)
+                self._write_rle(run_start, run_end)
+                literal_start = run_end
+
+        self._write_literal(literal_start, end)
+
+    def _write_literal(self, start, end):
+        """
+        Write modified_data[start:end] as literal records, the writer splits them at RECORD_LIMIT
+        """
+        if start == end:
+            return
+
+        # A record can't begin at the 'EOF' offset, it starts a byte earlier with that byte's new value
+        if start == EOF_OFFSET:
+            start -= 1
+
+        if end - start > RECORD_LIMIT and self.verbose:
+            print("Truncating overlong record: %s %s" % (RECORD_LIMIT, hex(RECORD_LIMIT)))
+
+        self.writer.write(start, memoryview(self.modified_data)[start:end])
+
+    def _write_rle(self, start, end):
+        """
+        Write modified_data[start:end], a single repeated byte, as RLE records
+        """
+        # Same 'EOF' caveat as literal records, the first byte of the run goes in a literal record
+        # starting one byte earlier
+        if start == EOF_OFFSET:
+            self._write_literal(start, start + 1)
+            start += 1
+
+        if start < end:
+            self.writer.write(start, end - start, self.modified_data[start])
+
+
+class BPSError(IPSError):
+    """Raised for BPS patches that can't be created or applied."""
+
+
+# sha1sum style list of the base ROMs patches are made for, checked before patching unless --no-check-sha1
+SHA1_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rom.sha1')
+
+
+def verify_base(data, sha1_file=SHA1_FILE):
+    """Raise IPSError unless the sha1 of data is listed in sha1_file."""
+    with open(sha1_file, 'r') as file:
+        digests = [line.split()[0].lower() for line in file if line.strip()]
+
+    digest = hashlib.sha1(data).hexdigest()
+    if digest not in digests:
+        raise IPSError('Base ROM sha1 %s is not listed in %s' % (digest, sha1_file))
+
+
+# Helper function to append a BPS variable length integer to a bytearray
+def put_varint(data, value):
+    while True:
+        x = value & 0x7F
+        value >>= 7
+        if value == 0:
+            data.append(0x80 | x)
+            return
+        data.append(x)
+        value -= 1
+
+
+# Helper function to get a BPS variable length integer from a bytearray, returns it with the next index
+def get_varint(data, index, end):
+    value = 0
+    shift = 1
+
+    while True:
+        if index >= end:
+            raise BPSError('Truncated number at %d' % index)
+
+        x = data[index]
+        index += 1
+        value += (x & 0x7F) * shift
+        if x & 0x80:
+            return value, index
+        shift <<= 7
+        value += shift
+
+
+# Helper function to get how many bytes match between a[i:] and b[j:], b may overlap a
+def match_length(a, i, b, j):
+    limit = min(len(a) - i, len(b) - j)
+    n = 0
+    step = 16
+
+    while n < limit:
+        step = min(step, limit - n)
+        if a[i + n:i + n + step] != b[j + n:j + n + step]:
+            while a[i + n] == b[j + n]:
+                n += 1
+            return n
+        n += step
+        step *= 2
+
+    return n
+
+
+class BPS(object):
+    """
+    BPS patches of a source ROM, kept in memory with its block index to create many patches
+
+    Unlike IPS, BPS patches carry CRC32s of the source, target and patch, and can copy data
+    from anywhere in the source or the target, so shifted data costs a few bytes.
+    """
+
+    # Actions, stored in the 2 low bits of the action header
+    SOURCE_READ = 0
+    TARGET_READ = 1
+    SOURCE_COPY = 2
+    TARGET_COPY = 3
+
+    # BPS file header 'BPS1'
+    BPS_ASCII = b"\x42\x50\x53\x31"
+
+    def __init__(self, source_data):
+        # Blocks of the source are dict keys, they have to be hashable
+        self.source_data = bytes(source_data)
+
+        # Bytes of the source indexed at once, copies shorter than a block are written as is
+        self.BLOCK = 8
+
+        # Shortest run of same offset bytes read from the source in the middle of new bytes
+        self.SOURCE_READ_MIN = 4
+
+        # Bytes compared at once when finding the same offset runs, see diff_runs
+        self.DIFF_BLOCK = 0x10000
+
+        self._index = None
+
+        # Actions written by the last create
+        self.action_count = 0
+
+    def block_index(self):
+        """
+        Return the dict mapping every BLOCK aligned block of the source to its first offset, built once
+        """
+        if self._index is None:
+            source_data = self.source_data
+            block = self.BLOCK
+            index = {}
+            for offset in range(len(source_data) - block, -1, -block):
+                index[source_data[offset:offset + block]] = offset
+            self._index = index
+
+        return self._index
+
+    def create(self, target_data):
+        """
+        Return the BPS patch turning the source into target_data
+
+        Bytes at the same offset in both are read from the source, other bytes are copied from a
+        matching block of the source, repeated from the target or written as is.
+        """
+        source_data = self.source_data
+        target_data = bytes(target_data)
+        target_len = len(target_data)
+        index = self.block_index()
+        block = self.BLOCK
+
+        patch = bytearray(self.BPS_ASCII)
+        put_varint(patch, len(source_data))
+        put_varint(patch, target_len)
+        put_varint(patch, 0)
+
+        # Runs of bytes that differ at the same offset, the source can be read as is between them
+        runs = list(diff_runs(source_data, target_data, self.DIFF_BLOCK))
+        run_starts = [start for start, end in runs]
+
+        source_relative = 0
+        target_relative = 0
+        literal_start = 0
+        offset = 0
+        self.action_count = 0
+
+        def write_action(action, length):
+            put_varint(patch, ((length - 1) << 2) | action)
+            self.action_count += 1
+
+        def write_relative(delta):
+            put_varint(patch, (abs(delta) << 1) | (delta < 0))
+
+        def write_literal(end):
+            if literal_start < end:
+                write_action(self.TARGET_READ, end - literal_start)
+                patch.extend(target_data[literal_start:end])
+
+        while offset < target_len:
+            # Same offset bytes
+            i = bisect.bisect_right(run_starts, offset) - 1
+            if i < 0 or offset >= runs[i][1]:
+                length = (run_starts[i + 1] if i + 1 < len(runs) else target_len) - offset
+                if length >= self.SOURCE_READ_MIN:
+                    write_literal(offset)
+                    write_action(self.SOURCE_READ, length)
+                    offset += length
+                    literal_start = offset
+                    continue
+
+            # Longest copy, from where the last source copy ended, a source block or the previous byte
+            action = None
+            length = 0
+            for source_offset in (source_relative, index.get(target_data[offset:offset + block])):
+                if source_offset is not None and source_offset < len(source_data):
+                    n = match_length(source_data, source_offset, target_data, offset)
+                    if n > length:
+                        action, length, copy_offset = self.SOURCE_COPY, n, source_offset
+
+            if offset > 0 and target_data[offset] == target_data[offset - 1]:
+                n = match_length(target_data, offset - 1, target_data, offset)
+                if n > length:
+                    action, length, copy_offset = self.TARGET_COPY, n, offset - 1
+
+            if length < block:
+                offset += 1
+                continue
+
+            # Blocks are found aligned in the source, the copy may start in the pending new bytes
+            if action == self.SOURCE_COPY:
+                while offset > literal_start and copy_offset > 0 and source_data[copy_offset - 1] == target_data[offset - 1]:
+                    offset -= 1
+                    copy_offset -= 1
+                    length += 1
+
+            write_literal(offset)
+            write_action(action, length)
+            if action == self.SOURCE_COPY:
+                write_relative(copy_offset - source_relative)
+                source_relative = copy_offset + length
+            else:
+                write_relative(copy_offset - target_relative)
+                target_relative = copy_offset + length
+            offset += length
+            literal_start = offset
+
+        write_literal(target_len)
+
+        patch += struct.pack('<LL', zlib.crc32(source_data), zlib.crc32(target_data))
+        patch += struct.pack('<L', zlib.crc32(patch))
+
+        return bytes(patch)
+
+    def apply(self, patch_data):
+        """
+        Return a bytearray of the source with the BPS patch_data applied
+
+        The patch and source checksums are checked before anything gets patched.
+        """
+        source_data = self.source_data
+        patch = memoryview(patch_data)
+        end = len(patch) - 12
+
+        if bytes(patch[:4]) != self.BPS_ASCII:
+            raise BPSError('Missing BPS1 header')
+        if end < 4:
+            raise BPSError('Truncated patch')
+
+        source_crc, target_crc, patch_crc = struct.unpack('<LLL', patch[end:])
+        if zlib.crc32(patch[:-4]) != patch_crc:
+            raise BPSError('Patch checksum mismatch')
+        if zlib.crc32(source_data) != source_crc:
+            raise BPSError('Source checksum mismatch, wrong base ROM')
+
+        source_len, a = get_varint(patch, 4, end)
+        target_len, a = get_varint(patch, a, end)
+        metadata_len, a = get_varint(patch, a, end)
+        a += metadata_len
+
+        if source_len != len(source_data):
+            raise BPSError('Source size mismatch, wrong base ROM')
+
+        target_data = bytearray(target_len)
+        source_relative = 0
+        target_relative = 0
+        offset = 0
+
+        while a < end:
+            data, a = get_varint(patch, a, end)
+            action = data & 3
+            length = (data >> 2) + 1
+            if offset + length > target_len:
+                raise BPSError('Action past the end of the target at %d' % a)
+
+            if action == self.SOURCE_READ:
+                if offset + length > source_len:
+                    raise BPSError('Source read past the end of the source at %d' % a)
+                target_data[offset:offset + length] = source_data[offset:offset + length]
+
+            elif action == self.TARGET_READ:
+                if a + length > end:
+                    raise BPSError('Truncated target read at %d' % a)
+                target_data[offset:offset + length] = patch[a:a + length]
+                a += length
+
+            else:
+                data, a = get_varint(patch, a, end)
+                delta = -(data >> 1) if data & 1 else data >> 1
+
+                if action == self.SOURCE_COPY:
+                    source_relative += delta
+                    if source_relative < 0 or source_relative + length > source_len:
+                        raise BPSError('Source copy out of the source at %d' % a)
+                    target_data[offset:offset + length] = source_data[source_relative:source_relative + length]
+                    source_relative += length
+                else:
+                    target_relative += delta
+                    if target_relative < 0 or target_relative >= offset:
+                        raise BPSError('Target copy out of the written target at %d' % a)
+
+                    # Copies overlapping the bytes they write repeat the bytes before them
+                    period = offset - target_relative
+                    if length <= period:
+                        target_data[offset:offset + length] = target_data[target_relative:target_relative + length]
+                    else:
+                        repeated = bytes(target_data[target_relative:offset]) * (length // period + 1)
+                        target_data[offset:offset + length] = repeated[:length]
+                    target_relative += length
+
+            offset += length
+
+        if offset != target_len:
+            raise BPSError('Truncated patch, %d of %d bytes written' % (offset, target_len))
+        if zlib.crc32(target_data) != target_crc:
+            raise BPSError('Target checksum mismatch')
+
+        return target_data
+
+
+# Streaming API: records are read and written one at a time, errors are raised as IPSError
+
+
+class IPSReader(object):
+    """
+    Iterate the records of an IPS patch read from a file object or a buffer
+
+    Records are (offset, data) or (offset, count, value) for RLE records, only one is held in
+    memory at a time. Data is a memoryview when reading a buffer. Reading stops at the 'EOF' footer.
+    """
+
+    def __init__(self, patch):
+        if hasattr(patch, 'read'):
+            self._read = patch.read
+        else:
+            view = memoryview(patch)
+            position = [0]
+
+            def read(size):
+                start = position[0]
+                position[0] = min(start + size, len(view))
+                return view[start:position[0]]
+
+            self._read = read
+
+    def _read_exactly(self, size, what, offset):
+        data = self._read(size)
+        if len(data) != size:
+            raise IPSError('Truncated %s at offset %d' % (what, offset))
+        return data
+
+    def __iter__(self):
+        if bytes(self._read(5)) != PATCH_ASCII:
+            raise IPSError('Missing PATCH header')
+
+        while True:
+            header = self._read(3)
+            if header == EOF_ASCII:
+                return
+            if len(header) != 3:
+                raise IPSError('Missing EOF footer')
+
+            offset = get_uint24(header, 0)
+            size = get_uint16(self._read_exactly(2, 'record header', offset), 0)
+
+            if size == 0:
+                rle = self._read_exactly(3, 'RLE record', offset)
+                yield offset, get_uint16(rle, 0), rle[2]
+            else:
+                yield offset, self._read_exactly(size, 'record', offset)
+
+
+class IPSWriter(object):
+    """
+    Write an IPS patch record by record to a file object or a bytearray
+
+    Records longer than RECORD_LIMIT are split. The footer is written by close, or when leaving
+    a with block without an error.
+
+    Format looks like (all integers in BIG endian):
+    [OFFSET into file : 3bytes][SIZE of record : 2bytes][BYTES : SIZEbytes]
+    [OFFSET into file : 3bytes][0 : 2bytes][RUN LENGTH : 2bytes][BYTE : 1byte]
+    """
+
+    def __init__(self, patch):
+        self._write = patch.write if hasattr(patch, 'write') else patch.extend
+        self.closed = False
+
+        # Accounting variables
+        self.record_count = 0
+        self.patch_size = len(PATCH_ASCII)
+
+        self._write(PATCH_ASCII)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, offset, data, value=None):
+        """
+        Write data at offset, or when value is given, value repeated data times as RLE records
+        """
+        if self.closed:
+            raise IPSError('Patch already closed')
+
+        if value is None:
+            length = len(data)
+            data = memoryview(data)
+        else:
+            length = data
+            if not 0 <= value <= 0xFF:
+                raise IPSError('RLE value %d is not a byte' % value)
+
+        if offset < 0 or length < 0 or offset + length > FILE_LIMIT:
+            raise IPSError('Record at offset %d of %d bytes is out of the 16MB IPS range' % (offset, length))
+        if length and offset == EOF_OFFSET:
+            raise IPSError('A record can\'t start at offset 0x454f46 ("EOF")')
+
+        start = 0
+        while start < length:
+            # From http://romhack.wikia.com/wiki/IPS in 'Caveats' section:
+            #
+            # The number 0x454f46 looks like "EOF" in ASCII, which is why a patch record must never begin at
+            # offset 0x454f46. If your program generates a patch record at offset 0x454f46, then you have a bug,
+            # because IPS patchers will read the "EOF". One possible workaround is to start at offset 0x454f45
+            # and include the extra byte in the patch.
+            #
+            # If a patch provides multiple values for the same byte in the patched file, then the IPS patcher
+            # may use any of these overlapped values. Also, if the patch extends the size of the patched file,
+            # but does not provide values for all bytes in the extended area, then the IPS patcher may fill the
+            # gaps with any values. A better IPS file provides no such overlapped values and no such gaps,
+            # though this is not a requirement of the IPS format.
+            #
+            # Records cut at the 'EOF' offset start one byte earlier and write the byte before it again.
+            if offset + start == EOF_OFFSET:
+                start -= 1
+
+            # Records have a max size of 0xFFFF as the size header is a short
+            size = min(length - start, RECORD_LIMIT)
+            self._write(struct.pack('>L', offset + start)[1:])
+            if value is None:
+                self._write(struct.pack('>H', size))
+                self._write(data[start:start + size])
+                self.patch_size += size + 5
+            else:
+                self._write(struct.pack('>HHB', 0, size, value))
+                self.patch_size += 8
+            self.record_count += 1
+            start += size
+
+    def close(self):
+        if not self.closed:
+            self._write(EOF_ASCII)
+            self.patch_size += len(EOF_ASCII)
+            self.closed = True
+
+
+# Batch API: one base ROM diffed against many ROMs in worker processes
+
+
+# Summary of a batch, written in the output directory
+MANIFEST_FILE = 'manifest.json'
+
+# Extensions of the ROMs taken from directories
+ROM_EXTENSIONS = ['.gb', '.gbc']
+
+# Base ROM of a batch worker process, an IPS base as bytes or a BPS with its block index, set once by _batch_init
+_batch_base = None
+
+
+def _batch_init(original_data, bps):
+    global _batch_base
+
+    if bps:
+        _batch_base = BPS(original_data)
+        _batch_base.block_index()
+    else:
+        _batch_base = original_data
+
+
+def _batch_create(modified_file, patch_file):
+    entry = {'rom': modified_file, 'patch': os.path.basename(patch_file)}
+
+    try:
+        with open(modified_file, 'rb') as file:
+            modified_data = file.read()
+
+        if isinstance(_batch_base, BPS):
+            patch_data = _batch_base.create(modified_data)
+            record_count = _batch_base.action_count
+        else:
+            patch_data, record_count = _create_ips(_batch_base, modified_data)
+
+        with open(patch_file, 'wb') as file:
+            file.write(patch_data)
+    except (IPSError, OSError) as error:
+        entry['error'] = str(error)
+        return entry
+
+    entry['rom_size'] = len(modified_data)
+    entry['size'] = len(patch_data)
+    entry['records'] = record_count
+
+    return entry
+
+
+def rom_files(paths, original_file=None):
+    """
+    Return the files of paths, directories are replaced by the sorted ROMs in them
+
+    Only files with a ROM_EXTENSIONS extension are taken from directories, and original_file never is.
+    """
+    files = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+
+        for name in sorted(os.listdir(path)):
+            file = os.path.join(path, name)
+            if os.path.splitext(name)[1].lower() not in ROM_EXTENSIONS or not os.path.isfile(file):
+                continue
+            if original_file is not None and os.path.samefile(file, original_file):
+                continue
+            files.append(file)
+
+    return files
+
+
+def create_patches(original_data, modified_files, patch_dir, bps=False, jobs=None):
+    """
+    Write a patch of every modified file against original_data to patch_dir, with a manifest
+
+    Patches are named after their ROM and created by jobs worker processes, os.cpu_count() when
+    None. Every worker loads the base ROM, and the BPS block index, once. Returns the manifest,
+    files that can't be read or diffed have an error in it instead of a patch.
+    """
+    os.makedirs(patch_dir, exist_ok=True)
+
+    extension = '.bps' if bps else '.ips'
+    patch_files = []
+    for modified_file in modified_files:
+        name = os.path.splitext(os.path.basename(modified_file))[0] + extension
+        patch_files.append(os.path.join(patch_dir, name))
+
+    if len(set(patch_files)) != len(patch_files):
+        raise IPSError('Modified files with the same name would write the same patch')
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(modified_files)))
+
+    if jobs == 1:
+        _batch_init(original_data, bps)
+        entries = list(map(_batch_create, modified_files, patch_files))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_batch_init, initargs=(original_data, bps)) as executor:
+            entries = list(executor.map(_batch_create, modified_files, patch_files, chunksize=4))
+
+    manifest = {
+        'format': extension[1:],
+        'base_size': len(original_data),
+        'base_sha1': hashlib.sha1(original_data).hexdigest(),
+        'total_size': sum(entry.get('size', 0) for entry in entries),
+        'patches': entries,
+    }
+
+    with open(os.path.join(patch_dir, MANIFEST_FILE), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+# Library API: work on bytes already in memory, errors are raised as IPSError
+
+
+def _create_ips(original_data, modified_data):
+    ips = IPS('-c', None, None, None)
+    ips.verbose = False
+    ips.original_data = original_data
+    ips.modified_data = modified_data
+    ips.patch_file_obj = io.BytesIO()
+    ips._diff()
+
+    return ips.patch_file_obj.getvalue(), ips.record_count
+
+
+def create_patch(original_data, modified_data):
+    """Return the IPS patch turning original_data into modified_data."""
+    return _create_ips(original_data, modified_data)[0]
+
+
+def create_bps_patch(original_data, modified_data):
+    """Return the BPS patch turning original_data into modified_data."""
+    return BPS(original_data).create(modified_data)
+
+
+def _check_base(data, check_sha1):
+    if check_sha1 and os.path.exists(SHA1_FILE):
+        verify_base(data)
+
+
+def apply_patch(original_data, patch_data, check_sha1=True):
+    """
+    Return a bytearray of original_data with the IPS or BPS patch_data applied
+
+    original_data is checked against SHA1_FILE first when it exists, unless check_sha1 is False.
+    """
+    _check_base(original_data, check_sha1)
+
+    if patch_data[:4] == BPS.BPS_ASCII:
+        return BPS(original_data).apply(patch_data)
+
+    ips = IPS('-a', None, None, None)
+    ips.verbose = False
+    ips.patch_file_obj = patch_data
+
+    return ips._patch(bytearray(original_data))
+
+
+def apply_patches(original_data, patches, check_sha1=True):
+    """
+    Return a bytearray of original_data with the IPS or BPS patches applied in order in one buffer
+
+    original_data is checked against SHA1_FILE first when it exists, unless check_sha1 is False.
+    """
+    _check_base(original_data, check_sha1)
+
+    ips = IPS('-a', None, None, None)
+    ips.verbose = False
+    ips.patch_file_objs = list(patches)
+
+    return ips._patch_all(bytearray(original_data))
+
+
+def compose_patches(patches):
+    """Return the single IPS patch equivalent to the IPS patches applied in order."""
+    ips = IPS('-j', None, None, None)
+    ips.verbose = False
+    ips.patch_file_objs = list(patches)
+    ips.patch_file_obj = io.BytesIO()
+    ips._compose()
+
+    return ips.patch_file_obj.getvalue()
+
+
+def apply_patch_in_place(file_to_patch, patch_data, check_sha1=True):
+    """
+    Apply the IPS patch_data to file_to_patch in place without loading the whole file
+
+    BPS patches are built from the whole file, it is read and rewritten. The file is checked against
+    SHA1_FILE first when it exists, unless check_sha1 is False.
+    """
+    if check_sha1 and os.path.exists(SHA1_FILE):
+        IPS('-am', file_to_patch, None, None)._verify_base()
+
+    if patch_data[:4] == BPS.BPS_ASCII:
+        with open(file_to_patch, 'rb') as file:
+            patched_data = BPS(file.read()).apply(patch_data)
+        with open(file_to_patch, 'wb') as file:
+            file.write(patched_data)
+        return
+
+    ips = IPS('-am', file_to_patch, None, None)
+    ips.verbose = False
+    ips.patch_file_objs = [patch_data]
+    ips._patch_in_place(file_to_patch)
+
+
+if __name__ == '__main__':
+    check_sha1 = '--no-check-sha1' not in sys.argv
+    if not check_sha1:
+        sys.argv.remove('--no-check-sha1')
+
+    arg_len = len(sys.argv)
+
+    if arg_len < 4:
+        usage()
+
+    if sys.argv[1] == '-a' or sys.argv[1] == '-am':
+        ips = IPS(sys.argv[1], sys.argv[2], '', sys.argv[3])
+        ips.patch_files = sys.argv[3:]
+        ips.check_sha1 = check_sha1 and os.path.exists(SHA1_FILE)
+        ips()
+
+    elif sys.argv[1] == '-cm' or sys.argv[1] == '-cmb':
+        if arg_len < 5:
+            usage()
+
+        ips = IPS(sys.argv[1], sys.argv[2], None, sys.argv[3])
+        ips.modified_files = sys.argv[4:]
+        ips()
+
+    elif sys.argv[1] == '-j':
+        ips = IPS(sys.argv[1], None, None, sys.argv[2])
+        ips.patch_files = sys.argv[3:]
+        ips()
+
+    elif sys.argv[1] == '-ab':
+        # sys.argv[4] is user supplied _patched_ file name.
+        # Keep the compability - note the order of arguments.
+        patched_file_name = 'Patched_'+sys.argv[2] if arg_len == 4 else sys.argv[4]
+        ips = IPS(sys.argv[1], sys.argv[2], patched_file_name, sys.argv[3])
+        ips.check_sha1 = check_sha1 and os.path.exists(SHA1_FILE)
+        ips()
+
+    elif sys.argv[1] == '-c' or sys.argv[1] == '-cb':
+        extension = '.ips' if sys.argv[1] == '-c' else '.bps'
+        patch_file_name = sys.argv[3]+extension if arg_len == 4 else sys.argv[4]
+        ips = IPS(sys.argv[1], sys.argv[2], sys.argv[3], patch_file_name)
+        ips()
+
+    else:
+        usage()
+
     sys.exit(0)
\ No newline at end of file
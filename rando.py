@@ -2,13 +2,36 @@
 
 import sys
 import json
+import argparse
+import asyncio
 import random
-import subprocess
+import io
+import os
+import re
+import pickle
+import hashlib
+import http.server
 import shutil
+import signal
+import concurrent.futures
+import fcntl
+import cProfile
+import threading
+import time
+import urllib.parse
+import uuid
+from contextlib import contextmanager, nullcontext
 from collections import Counter
 from functools import partial
 from enum import IntEnum
 
+import lipx
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 open_utf8 = partial(open, encoding="utf8")
 
 # The base bit-noise constants were crafted to have distinctive and interesting
@@ -41,6 +64,42 @@ def noise3d(x, y, z, seed=0):
     return noise1d(x + PRIME1 * y + PRIME2 * z, seed)
 
 
+# Array versions of the noise functions, taking and returning numpy arrays (the seed can be an array
+# too). Every intermediate value of the scalar versions only matters through its low 48 bits, so
+# uint64 wraparound arithmetic is bit-exact with them.
+def as_uint64(n):
+    if np is None:
+        raise ImportError("numpy is required for the array noise functions")
+
+    n = np.asarray(n)
+    if n.dtype.kind == "i":
+        return n.astype(np.int64).astype(np.uint64)
+    return n.astype(np.uint64)
+
+
+def noise1d_array(n, seed=0):
+    n = as_uint64(n)
+    with np.errstate(over="ignore"):
+        n = n * np.uint64(NOISE1)
+        n = n + as_uint64(seed)
+        n = n ^ (n >> np.uint64(8))
+        n = n + np.uint64(NOISE2)
+        n = n ^ (n << np.uint64(8))
+        n = n * np.uint64(NOISE3)
+        n = n ^ (n >> np.uint64(8))
+    return (n & np.uint64(CAP - 1)).astype(np.uint32)
+
+
+def noise2d_array(x, y, seed=0):
+    with np.errstate(over="ignore"):
+        return noise1d_array(as_uint64(x) + np.uint64(PRIME1) * as_uint64(y), seed)
+
+
+def noise3d_array(x, y, z, seed=0):
+    with np.errstate(over="ignore"):
+        return noise1d_array(as_uint64(x) + np.uint64(PRIME1) * as_uint64(y) + np.uint64(PRIME2) * as_uint64(z), seed)
+
+
 def pick(l, n):
     return l[n % len(l)]
 
@@ -58,6 +117,99 @@ def clamp(n, smallest, largest):
     return max(smallest, min(n, largest))
 
 
+def chance(n, probability):
+    return n < probability * CAP
+
+
+# Counter-based stream of noise values, draw i of stream (x, y) is noise3d(x, y, i, seed)
+class NoiseStream:
+    def __init__(self, x, y, seed=0):
+        self.x = x
+        self.y = y
+        self.seed = seed
+        self.counter = 0
+
+    def next(self):
+        n = noise3d(self.x, self.y, self.counter, self.seed)
+        self.counter += 1
+        return n
+
+    # Next count draws at once, computed in bulk when numpy is available
+    def take(self, count):
+        counters = range(self.counter, self.counter + count)
+        self.counter += count
+        if np is None:
+            return [noise3d(self.x, self.y, z, self.seed) for z in counters]
+        return noise3d_array(self.x, self.y, np.arange(counters.start, counters.stop), self.seed).tolist()
+
+    # Fisher-Yates shuffle in place
+    def shuffle(self, l):
+        draws = self.take(max(len(l) - 1, 0))
+        for i in range(len(l) - 1, 0, -1):
+            j = draws[len(l) - 1 - i] % (i + 1)
+            l[i], l[j] = l[j], l[i]
+
+
+# A field label is followed by the number of source lines making up the field
+FIELD_LABEL = ".rando_field_{} ; lines: {}\n"
+FIELD_LABEL_PATTERN = re.compile(r"\.rando_field_\d+ ; lines: (\d+)\n")
+
+
+# Source text with every field, label included, left out
+def mask_fields(text):
+    parts = []
+    position = 0
+    for match in FIELD_LABEL_PATTERN.finditer(text):
+        parts.append(text[position : match.start()])
+        position = match.end()
+        for i in range(int(match.group(1))):
+            position = text.index("\n", position) + 1
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+# Bytes of a field value as expressions evaluated by AsmConstants
+def word_values(expr):
+    return ["({}) & 0xff".format(expr), "({}) >> 8".format(expr)]
+
+
+# Bytes of the energy macro of src/macros/data.asm, NUM_TYPES / 2 bytes holding a nybble per type
+ENERGY_BYTES = 4
+
+
+def energy_values(args):
+    amounts = ["({} << ({} * 4 + 4 - 8 * ({} % 2)))".format(args[i + 1], args[i], args[i]) for i in range(0, len(args) - 1, 2)]
+    en = " + ".join(amounts) or "0"
+    return ["(({}) >> {}) & 0xff".format(en, i * 8) for i in range(ENERGY_BYTES)]
+
+
+# Bytes of a db, dw, tx or energy line
+def directive_values(line):
+    directive, args = line.split(";")[0].split(None, 1)
+    args = [arg.strip() for arg in args.split(",")]
+    if directive == "db":
+        return args
+    if directive == "dw":
+        return [value for arg in args for value in word_values(arg)]
+    if directive == "tx":
+        return word_values(args[0] + "_")
+    if directive == "energy":
+        return energy_values(args)
+    raise ValueError("not a field directive: {}".format(line))
+
+
+# Half-width characters remapped by src/constants/charmaps.asm
+CHARMAP = {"é": "`", "♂": "$", "♀": "%", "”": '"'}
+TEXT_LINE = re.compile(r'^\t(text|line) "([^"]*)"')
+
+
+# Bytes of a text or line macro of src/macros/text.asm
+def text_values(line):
+    match = TEXT_LINE.match(line)
+    command = "TX_HALFWIDTH" if match.group(1) == "text" else "TX_LINE"
+    return [command] + [ord(CHARMAP.get(char, char)) for char in match.group(2)]
+
+
 class PokemonEvolutionType(IntEnum):
     BASIC_NO_EVOLUTION = 0
     BASIC_ONE_EVOLUTION = 1
@@ -67,6 +219,727 @@ class PokemonEvolutionType(IntEnum):
     EVO2_TWO_EVOLUTION = 5
 
 
+# Draws cards weighted by how many more copies of each fit in a deck (limit minus count so far),
+# the capacities are kept in a Fenwick tree so every draw and update is O(log n)
+class CapacitySampler:
+    def __init__(self, cards, counts):
+        self.cards = []
+        self.index = {}
+        for card in cards:
+            # The same card can't be listed twice
+            if card["constant"] not in self.index:
+                self.index[card["constant"]] = len(self.cards)
+                self.cards.append(card)
+
+        self.capacity = [max(card["limit"] - counts[card["constant"]], 0) for card in self.cards]
+
+        self.tree = [0] * (len(self.cards) + 1)
+        for i, capacity in enumerate(self.capacity):
+            j = i + 1
+            self.tree[j] += capacity
+            parent = j + (j & -j)
+            if parent <= len(self.cards):
+                self.tree[parent] += self.tree[j]
+
+    def total(self):
+        total = 0
+        i = len(self.cards)
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def update(self, i, delta):
+        self.capacity[i] += delta
+        i += 1
+        while i <= len(self.cards):
+            self.tree[i] += delta
+            i += i & -i
+
+    # Card covering the n-th unit of remaining capacity, n taken modulo the total
+    def draw(self, n):
+        n %= self.total()
+
+        i = 0
+        step = 1 << len(self.cards).bit_length()
+        while step:
+            j = i + step
+            if j <= len(self.cards) and self.tree[j] <= n:
+                i = j
+                n -= self.tree[j]
+            step >>= 1
+        return self.cards[i]
+
+    # Uses up one copy of a card, cards from outside the sampler are ignored
+    def take(self, card):
+        i = self.index.get(card["constant"])
+        if i is not None and self.capacity[i] > 0:
+            self.update(i, -1)
+
+
+# A single card of templates/cards.asm, fields are line indexes into CardsTemplate.lines
+class CardTemplate:
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+        self.stage = ""
+        self.rarity = None
+        self.set = None
+        self.hp = None
+        self.weakness = None
+        self.resistance = None
+        self.retreat_cost = None
+
+        # Raw attack blocks without their "; attack #" header, and the lines they span
+        self.attacks = []
+        self.attacks_start = None
+        self.attacks_end = None
+
+    def is_pokemon(self):
+        return "TYPE_PKMN" in self.type
+
+    def color(self):
+        return self.type[10:]
+
+
+# templates/cards.asm parsed once into its lines and the cards found between them
+class CardsTemplate:
+    def __init__(self, lines):
+        self.lines = lines
+        self.cards = []
+
+        card = None
+        i = 0
+        while i < len(self.lines):
+            line = self.lines[i]
+
+            if "CARD_NAME" in line:
+                card = CardTemplate(line.split(":")[0], self.lines[i + 1].split(" ")[1])
+                self.cards.append(card)
+            elif card is None:
+                pass
+            elif "RANDOMIZE_RARITY" in line:
+                card.rarity = i
+            elif "RANDOMIZE_SET" in line:
+                card.set = i
+            elif "; hp" in line:
+                card.hp = i
+            elif "; stage" in line:
+                card.stage = line.split(" ")[1]
+            elif "; weakness" in line:
+                card.weakness = i
+            elif "; resistance" in line:
+                card.resistance = i
+            elif "; retreat cost" in line:
+                card.retreat_cost = i
+            elif "; attack" in line:
+                if card.attacks_start is None:
+                    card.attacks_start = i
+
+                # Don't save the ; attack # here
+                attack = ""
+                i += 1
+                while self.lines[i] != "\n":
+                    attack += self.lines[i]
+                    i += 1
+
+                card.attacks.append(attack)
+                card.attacks_end = i + 1
+
+            i += 1
+
+    # Plain data form stored by TemplateCache
+    def get_state(self):
+        return self.lines, [card.__dict__ for card in self.cards]
+
+    @staticmethod
+    def from_state(state):
+        template = CardsTemplate([])
+        template.lines = state[0]
+        for fields in state[1]:
+            card = CardTemplate(fields["name"], fields["type"])
+            card.__dict__.update(fields)
+            template.cards.append(card)
+        return template
+
+
+# An attack block parsed into its fields. The block text is kept to render the attack back with
+# the energies of another card.
+class Attack:
+    __slots__ = ["energies", "cost", "name", "damage", "category", "effect", "flags", "animation", "text", "rendered", "values"]
+
+    ENERGIES = ["GRASS", "FIRE", "WATER", "LIGHTNING", "FIGHTING", "PSYCHIC"]
+
+    def __init__(self, text):
+        fields = []
+        for line in text.split("\n"):
+            if line.strip():
+                fields.append(line.split(";")[0].split(None, 1)[1].strip())
+
+        # "GRASS, 1, COLORLESS, 2" -> (("GRASS", 1), ("COLORLESS", 2)), "0" -> ()
+        amounts = [amount.strip() for amount in fields[0].split(",")]
+        self.energies = tuple((amounts[i], int(amounts[i + 1])) for i in range(0, len(amounts) - 1, 2))
+        self.cost = sum(amount for energy, amount in self.energies)
+
+        self.name = None if fields[1] == "NONE" else fields[1]
+        self.damage = int(fields[4])
+        self.category = fields[5]
+        self.effect = None if fields[6] == "NONE" else fields[6]
+        self.flags = (fields[7], fields[8], fields[9], fields[10])
+        self.animation = fields[11]
+        self.text = text
+        self.rendered = {}
+        self.values = {}
+
+    # Block text with the first colored energy, in ENERGIES order, replaced by the card color
+    def render(self, color):
+        rendered = self.rendered.get(color)
+        if rendered is None:
+            rendered = self.text
+            energies = [energy for energy, amount in self.energies]
+            for energy in Attack.ENERGIES:
+                if energy in energies:
+                    rendered = rendered.replace(energy + ",", color + ",")
+                    break
+            self.rendered[color] = rendered
+        return rendered
+
+    # Bytes of the block rendered for color, see field_line
+    def field_values(self, color):
+        values = self.values.get(color)
+        if values is None:
+            values = []
+            for line in self.render(color).split("\n"):
+                if line.strip():
+                    values.extend(directive_values(line))
+            self.values[color] = values
+        return values
+
+
+# Weak attack given to pokemon without any damage attack, per evolution type
+TACKLE = Attack(
+    """\tenergy COLORLESS, 1 ; energies
+                \ttx TackleName ; name
+                \tdw NONE ; description
+                \tdw NONE ; description (cont)
+                \tdb 10 ; damage
+                \tdb DAMAGE_NORMAL ; category
+                \tdw NONE ; effect commands
+                \tdb NONE ; flags 1
+                \tdb NONE ; flags 2
+                \tdb NONE ; flags 3
+                \tdb 0
+                \tdb ATK_ANIM_HIT ; animation"""
+)
+POUND = Attack(
+    """\tenergy COLORLESS, 2 ; energies
+                \ttx PoundName ; name
+                \tdw NONE ; description
+                \tdw NONE ; description (cont)
+                \tdb 20 ; damage
+                \tdb DAMAGE_NORMAL ; category
+                \tdw NONE ; effect commands
+                \tdb NONE ; flags 1
+                \tdb NONE ; flags 2
+                \tdb NONE ; flags 3
+                \tdb 0
+                \tdb ATK_ANIM_HIT ; animation"""
+)
+SLASH = Attack(
+    """\tenergy COLORLESS, 3 ; energies
+                \ttx SlashName ; name
+                \tdw NONE ; description
+                \tdw NONE ; description (cont)
+                \tdb 20 ; damage
+                \tdb DAMAGE_NORMAL ; category
+                \tdw NONE ; effect commands
+                \tdb NONE ; flags 1
+                \tdb NONE ; flags 2
+                \tdb NONE ; flags 3
+                \tdb 0
+                \tdb ATK_ANIM_SLASH ; animation"""
+)
+
+
+# Attacks of the cards template parsed once. Each card keeps its own records, non empty ones are
+# also grouped by evolution type and damage, seeds draw from those groups by index.
+class AttackPools:
+    def __init__(self, cards_template, evolution_types):
+        self.evolution_types = evolution_types
+        self.card_attacks = []
+        self.damage = [[] for i in PokemonEvolutionType]
+        self.non_damage = [[] for i in PokemonEvolutionType]
+
+        for card, pokemon_evolution_type in zip(cards_template.cards, evolution_types):
+            attacks = [Attack(text) for text in card.attacks]
+            self.card_attacks.append(attacks)
+
+            for attack in attacks:
+                if attack.name is None:
+                    continue
+
+                if attack.damage == 0:
+                    self.non_damage[pokemon_evolution_type].append(attack)
+                else:
+                    self.damage[pokemon_evolution_type].append(attack)
+
+
+# Order a pool of count attacks is drawn in. The indexes are shuffled and doubled until there are
+# at least 300, so every pokemon gets an attack, then shuffled once more.
+def attack_order(count, stream):
+    order = list(range(count))
+    while len(order) < 300:
+        stream.shuffle(order)
+        order.extend(order)
+    stream.shuffle(order)
+    return order
+
+
+# Attack2 becomes attack1 when it is cheaper, or as expensive and weaker. Damages are compared as
+# text, so 100 sorts before 20, this is kept so seeds keep generating the same cards.
+def order_attacks(attack1, attack2):
+    if attack1.cost > attack2.cost or (attack1.cost == attack2.cost and str(attack1.damage) > str(attack2.damage)):
+        return attack2, attack1
+    return attack1, attack2
+
+
+# A template split into literal chunks and hook slots. Consecutive literal lines are merged into a
+# single chunk, marker lines become (hook, line) slots filled by the randomize_* methods.
+class CompiledTemplate:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    @staticmethod
+    def compile(lines, markers):
+        chunks = []
+
+        literal = []
+        for line in lines:
+            hook = next((hook for marker, hook in markers if marker in line), None)
+            if hook is None:
+                literal.append(line)
+                continue
+
+            if literal:
+                chunks.append("".join(literal))
+                literal = []
+            chunks.append((hook, line))
+
+        if literal:
+            chunks.append("".join(literal))
+
+        return chunks
+
+    def render(self, target, hooks={}):
+        for chunk in self.chunks:
+            if isinstance(chunk, str):
+                target.write(chunk)
+            else:
+                hooks[chunk[0]](target, chunk[1])
+
+
+# On-disk cache of compiled templates. Entries are reused while the template mtime and size match,
+# or when its content hash is still the same. The compiled state also depends on the parser code
+# and on what the template is compiled with, an entry made by another rando.py or with other
+# depends is compiled again.
+class TemplateCache:
+    VERSION = 2
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.dirty = False
+
+        with open(os.path.abspath(__file__), "rb") as file:
+            self.code_hash = hashlib.sha1(file.read()).hexdigest()
+
+        try:
+            with open(cache_file, "rb") as file:
+                version, entries = pickle.load(file)
+            if version == TemplateCache.VERSION:
+                self.entries = entries
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    # Compiled state of a template, compile is called with its lines on a miss. depends is anything
+    # else compile uses, compared through its repr.
+    def get(self, path, compile, key=None, depends=None):
+        key = key or path
+        compiled_with = hashlib.sha1((self.code_hash + repr(depends)).encode("utf8")).hexdigest()
+        stat = os.stat(path)
+        entry = self.entries.get(key)
+        if entry and entry["compiled_with"] != compiled_with:
+            entry = None
+        if entry and (entry["mtime"], entry["size"]) == (stat.st_mtime_ns, stat.st_size):
+            return entry["state"]
+
+        with open(path, "rb") as file:
+            data = file.read()
+        digest = hashlib.sha1(data).hexdigest()
+
+        if not entry or entry["hash"] != digest:
+            lines = io.StringIO(data.decode("utf8"), newline=None).readlines()
+            entry = {"hash": digest, "compiled_with": compiled_with, "state": compile(lines)}
+
+        entry["mtime"] = stat.st_mtime_ns
+        entry["size"] = stat.st_size
+        self.entries[key] = entry
+        self.dirty = True
+        return entry["state"]
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        tmp_file = self.cache_file + ".tmp{}".format(os.getpid())
+        with open(tmp_file, "wb") as file:
+            pickle.dump((TemplateCache.VERSION, self.entries), file)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
+
+
+# Collects wall and CPU time per phase, output sizes and noise function calls for --profile. One
+# phase can also be run under cProfile.
+class Profiler:
+    NOISE_FUNCTIONS = ["noise1d", "noise2d", "noise3d", "noise1d_array", "noise2d_array", "noise3d_array"]
+
+    def __init__(self, cprofile_phase=None):
+        self.phases = {}
+        self.outputs = {}
+        self.noise_calls = Counter()
+        self.cprofile_phase = cprofile_phase
+        self.cprofile = cProfile.Profile() if cprofile_phase else None
+        self.originals = {}
+
+        # Noise functions call each other, only the outermost call is counted
+        self.noise_depth = 0
+
+    @contextmanager
+    def phase(self, name):
+        if name == self.cprofile_phase:
+            self.cprofile.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            stats = self.phases.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            stats["calls"] += 1
+            stats["wall"] += time.perf_counter() - wall
+            stats["cpu"] += time.process_time() - cpu
+            if name == self.cprofile_phase:
+                self.cprofile.disable()
+
+    def record_output(self, path, size, written):
+        stats = self.outputs.setdefault(path, {"renders": 0, "writes": 0, "bytes": 0, "bytes_written": 0})
+        stats["renders"] += 1
+        stats["bytes"] += size
+        if written:
+            stats["writes"] += 1
+            stats["bytes_written"] += size
+
+    # Swaps the module noise functions for counting wrappers until uninstall is called
+    def install(self):
+        module = sys.modules[__name__]
+        for name in Profiler.NOISE_FUNCTIONS:
+            function = getattr(module, name)
+            self.originals[name] = function
+            setattr(module, name, self.counter(name, function))
+
+    def uninstall(self):
+        module = sys.modules[__name__]
+        for name, function in self.originals.items():
+            setattr(module, name, function)
+        self.originals = {}
+
+        # Noise functions call each other, only the outermost call is counted
+        self.noise_depth = 0
+
+    def counter(self, name, function):
+        def count(*args, **kwargs):
+            if self.noise_depth:
+                return function(*args, **kwargs)
+
+            self.noise_calls[name] += 1
+            self.noise_depth += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.noise_depth -= 1
+
+        return count
+
+    def report(self):
+        return {
+            "phases": self.phases,
+            "outputs": self.outputs,
+            "noise_calls": dict(self.noise_calls),
+        }
+
+    def dump_stats(self, stats_file):
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(stats_file)
+
+
+def profile_phase(profiler, name):
+    if profiler is None:
+        return nullcontext()
+    return profiler.phase(name)
+
+
+# Collects a rendered source file, writing it under output_dir once closed. Files whose content
+# didn't change aren't rewritten. This only saves the writes: main.o and text.o include files that
+# change with every seed, so make reassembles them either way.
+class OutputFile(io.StringIO):
+    def __init__(self, ptcg, path):
+        super().__init__()
+        self.ptcg = ptcg
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            content = self.getvalue()
+            self.ptcg.rendered[self.path] = content
+            written = False
+            if self.ptcg.write_outputs:
+                written = self.write_file(content)
+            if self.ptcg.profiler is not None:
+                self.ptcg.profiler.record_output(self.path, len(content.encode("utf8")), written)
+        super().close()
+
+    def write_file(self, content):
+        path = os.path.join(self.ptcg.output_dir, self.path)
+        digest = hashlib.sha1(content.encode("utf8")).hexdigest()
+
+        # (hash, mtime, size) of the file as last written or checked by this instance
+        written = self.ptcg.written.get(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+
+        if stat is not None:
+            current = (stat.st_mtime_ns, stat.st_size)
+            if written is not None and written[1:] == current:
+                if written[0] == digest:
+                    return False
+            else:
+                with open_utf8(path, "r") as file:
+                    if hashlib.sha1(file.read().encode("utf8")).hexdigest() == digest:
+                        self.ptcg.written[path] = (digest,) + current
+                        return False
+
+        with open_utf8(path, "w") as target:
+            target.write(content)
+
+        stat = os.stat(path)
+        self.ptcg.written[path] = (digest, stat.st_mtime_ns, stat.st_size)
+        return True
+
+
+# Numeric values of the assembler constants used by the fields. Text ids are numbered by the
+# textpointer lines of the text offsets template.
+class AsmConstants:
+    FILES = [
+        "src/constants/card_data_constants.asm",
+        "src/constants/card_constants.asm",
+        "src/constants/attack_animation_constants.asm",
+        "src/constants/duel_constants.asm",
+        "src/constants/deck_constants.asm",
+        "src/constants/music_constants.asm",
+        "src/constants/booster_constants.asm",
+        "src/constants/text_constants.asm",
+        "templates/text_offsets.asm",
+    ]
+
+    EQU = re.compile(r"^(\w+)\s+EQU\s+(.+)$")
+
+    def __init__(self, root="."):
+        self.values = {"const_value": 0}
+        self.text_count = 0
+
+        for path in AsmConstants.FILES:
+            with open_utf8(os.path.join(root, path), "r") as src:
+                for line in src:
+                    self.parse_line(line.split(";")[0].strip())
+
+    def parse_line(self, line):
+        parts = line.split(None, 1)
+        if not parts:
+            return
+
+        if parts[0] == "const_def":
+            self.values["const_value"] = self.evaluate(parts[1]) if len(parts) > 1 else 0
+        elif parts[0] in ("const", "deck_const"):
+            name = parts[1].strip()
+            if parts[0] == "deck_const" and self.values["const_value"] >= 2:
+                self.values[name + "_ID"] = self.values["const_value"] - 2
+            self.values[name] = self.values["const_value"]
+            self.values["const_value"] += 1
+        elif parts[0] == "textpointer":
+            self.values[parts[1].strip() + "_"] = self.values["const_value"]
+            self.values["const_value"] += 1
+            self.text_count += 1
+        else:
+            match = AsmConstants.EQU.match(line)
+            if match:
+                try:
+                    self.values[match.group(1)] = self.evaluate(match.group(2))
+                except (KeyError, SyntaxError, TypeError):
+                    pass
+
+    # Names missing from the constants are looked up in labels, label addresses of a build. Single
+    # character strings such as TX_LINE are their character code.
+    def evaluate(self, expr, labels={}):
+        if isinstance(expr, int):
+            return expr
+        if expr.startswith('"'):
+            return ord(eval(expr, {"__builtins__": {}}))
+
+        expr = re.sub(r"\$([0-9a-fA-F]+)", r"0x\1", expr)
+        expr = re.sub(r"%([01]+)", r"0b\1", expr)
+        expr = re.sub(r"\b[A-Za-z_]\w*\b", lambda m: str(self.values[m.group()] if m.group() in self.values else labels[m.group()]), expr)
+        return eval(expr, {"__builtins__": {}})
+
+    # Bytes of a field, values wider than a byte are truncated like db does
+    def field_bytes(self, values, labels={}):
+        return bytes(self.evaluate(value, labels) & 0xFF for value in values)
+
+
+# Writes the fields of a seed straight into the ROM of a reference build sharing the same layout.
+# Text fields may change size: the rest of their bank moves along into the padding rgblink leaves
+# at its end, and the TextOffsets entries of the texts that moved are shifted to match.
+class RomPatcher:
+    BANK_SIZE = 0x4000
+
+    # rgblink -p value of the Makefile
+    PAD = 0xFF
+
+    def __init__(self, ref_dir):
+        self.ref_dir = ref_dir
+        with open(os.path.join(ref_dir, "poketcg.gbc"), "rb") as rom:
+            self.rom = rom.read()
+        with open_utf8(os.path.join(ref_dir, "fields.json"), "r") as file:
+            reference = json.load(file)
+        self.fields = reference["fields"]
+        self.labels = reference["labels"]
+        self.text_offsets = reference["text_offsets"]
+
+    # ROM offset and address of every label of a build, read from its sym file
+    @staticmethod
+    def read_symbols(sym_file):
+        symbols = {}
+        with open_utf8(sym_file, "r") as sym:
+            for line in sym:
+                parts = line.split(";")[0].split()
+                if len(parts) != 2 or ":" not in parts[0]:
+                    continue
+                bank, address = (int(x, 16) for x in parts[0].split(":"))
+                offset = address if bank == 0 else bank * RomPatcher.BANK_SIZE + address - RomPatcher.BANK_SIZE
+                symbols[parts[1]] = (offset, address)
+        return symbols
+
+    # Saves a build made with field markers as the reference for its layout
+    @staticmethod
+    def save_reference(ref_dir, work_dir, fields, constants):
+        symbols = RomPatcher.read_symbols(os.path.join(work_dir, "poketcg.sym"))
+        labels = {name: address for name, (offset, address) in symbols.items() if "." not in name}
+        offsets = {}
+        for name, (offset, address) in symbols.items():
+            if ".rando_field_" in name:
+                offsets[int(name.split(".rando_field_")[1])] = offset
+
+        with open(os.path.join(work_dir, "poketcg.gbc"), "rb") as rom:
+            data = rom.read()
+
+        # Refuse references whose recorded values don't match the assembled bytes
+        reference_fields = []
+        for i, (values, skip, text) in enumerate(fields):
+            try:
+                expected = constants.field_bytes(values, labels)
+            except (KeyError, SyntaxError, TypeError):
+                return False
+            offset = offsets.get(i)
+            if offset is None or data[offset + skip : offset + skip + len(expected)] != expected:
+                return False
+            reference_fields.append([offset + skip, len(expected)])
+
+        reference = {"fields": reference_fields, "labels": labels, "text_offsets": symbols["TextOffsets"][0]}
+        tmp_dir = ref_dir + ".tmp{}".format(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        shutil.copyfile(os.path.join(work_dir, "poketcg.gbc"), os.path.join(tmp_dir, "poketcg.gbc"))
+        with open_utf8(os.path.join(tmp_dir, "fields.json"), "w") as file:
+            json.dump(reference, file)
+        try:
+            os.rename(tmp_dir, ref_dir)
+        except OSError:
+            # Another worker saved the same layout first
+            shutil.rmtree(tmp_dir)
+        return True
+
+    # Patched ROM, None when the fields don't fit the reference layout
+    def patch(self, fields, constants):
+        rom = bytearray(self.rom)
+        moved = {}
+        for (offset, length), (values, skip, text) in zip(self.fields, fields):
+            data = constants.field_bytes(values, self.labels)
+            if len(data) == length:
+                rom[offset : offset + length] = data
+            elif text:
+                moved.setdefault(offset // RomPatcher.BANK_SIZE, []).append((offset, length, data))
+            else:
+                return None
+
+        for bank, changes in moved.items():
+            if not self.move_texts(rom, bank, changes, constants.text_count):
+                return None
+
+        # Global checksum written by rgbfix -v
+        checksum = (sum(rom) - rom[0x14E] - rom[0x14F]) & 0xFFFF
+        rom[0x14E:0x150] = checksum.to_bytes(2, "big")
+        return rom
+
+    # Rewrites a text bank with fields of another size, False when its texts no longer fit
+    def move_texts(self, rom, bank, changes, text_count):
+        start = bank * RomPatcher.BANK_SIZE
+        end = start + RomPatcher.BANK_SIZE
+
+        content = bytearray()
+        position = start
+        deltas = []
+        for offset, length, data in sorted(changes):
+            content += rom[position:offset]
+            content += data
+            position = offset + length
+            deltas.append((offset, len(data) - length))
+        content += rom[position:end]
+
+        # Only the padding past the end of the section can be dropped
+        if any(byte != RomPatcher.PAD for byte in content[RomPatcher.BANK_SIZE :]):
+            return False
+        rom[start:end] = content[: RomPatcher.BANK_SIZE].ljust(RomPatcher.BANK_SIZE, bytes([RomPatcher.PAD]))
+
+        # TextOffsets entries are 3 byte offsets of the texts from TextOffsets, entry 0 is unused
+        for i in range(1, text_count + 1):
+            entry = self.text_offsets + i * 3
+            target = self.text_offsets + int.from_bytes(rom[entry : entry + 3], "little")
+            if target // RomPatcher.BANK_SIZE != bank:
+                continue
+            target += sum(delta for offset, delta in deltas if offset < target)
+            rom[entry : entry + 3] = (target - self.text_offsets).to_bytes(3, "little")
+        return True
+
+
+# Removes the least recently used of (mtime, size, path) entries until they fit in max_size bytes
+def evict_lru(entries, max_size, remove):
+    total = sum(size for mtime, size, path in entries)
+    entries.sort()
+    while total > max_size and entries:
+        mtime, size, path = entries.pop(0)
+        remove(path)
+        total -= size
+
+
 class PTCGRando:
     RAND_CARDS = 10
     RAND_NPC_DECKS = 20
@@ -74,6 +947,8 @@ class PTCGRando:
     RAND_MASTERS = 40
     RAND_STARTER_DECKS = 50
     RAND_NPC_NAMES = 60
+    RAND_ATTACKS = 70
+    RAND_STARTER_COLORS = 80
 
     TYPE_PKMN = 0
     TYPE_ENERGY = 1
@@ -84,9 +959,122 @@ class PTCGRando:
     STAGE_2 = 2
     STAGE_NONE = 3
 
+    # randomize_* methods run for each seed, in order
+    PHASES = [
+        "randomize_cards",
+        "randomize_bank03",
+        "randomize_bank04",
+        "randomize_home",
+        "randomize_decks",
+        "randomize_text_offsets",
+        "randomize_text2",
+        "randomize_text3",
+        "randomize_text4",
+        "randomize_text5",
+        "randomize_text6",
+        "randomize_text7",
+        "randomize_text8",
+        "randomize_text9",
+    ]
+
+    # Entries per starter deck, the decks share bank $0c with the cards and three of this size still
+    # fit in it
+    STARTER_DECK_ENTRIES = 45
+
+    # Attributes changing the generated ROM, part of the patch cache key
+    OPTIONS = [
+        "group_by_evolution",
+        "exclude_prize",
+        "prize_full_random",
+        "prize_range",
+        "prize_min",
+        "prize_max",
+        "exclude_decks",
+        "exclude_music",
+        "exclude_boosters",
+        "booster_original_amount",
+        "booster_min",
+        "booster_max",
+        "min_pokemon",
+        "max_pokemon",
+        "min_trainer",
+        "max_trainer",
+        "starter_color_min",
+        "starter_color_max",
+        "exclude_npcs",
+    ]
+
+    # Sources written by the randomize_* methods, relative to output_dir
+    OUTPUTS = [
+        "src/data/cards.asm",
+        "src/engine/bank03.asm",
+        "src/engine/bank04.asm",
+        "src/engine/home.asm",
+        "src/data/decks.asm",
+        "src/text/text_offsets.asm",
+        "src/text/text2.asm",
+        "src/text/text3.asm",
+        "src/text/text4.asm",
+        "src/text/text5.asm",
+        "src/text/text6.asm",
+        "src/text/text7.asm",
+        "src/text/text8.asm",
+        "src/text/text9.asm",
+    ]
+
+    # Extensions of the files make reads from src and tools, build products are left out
+    BUILD_SOURCES = [".asm", ".inc", ".bin", ".png", ".c", ".h", ".py"]
+
+    # Templates and the markers turned into hooks when compiling them
+    TEMPLATES = {
+        "templates/bank03.asm": [("; DUEL:", "duel"), ("; BOOSTERS:", "boosters"), ("; MASTER_CHECK:", "master_check")],
+        "templates/bank04.asm": [],
+        "templates/home.asm": [],
+        "templates/decks.asm": [("; GENERATE_DECK:", "starter_deck")],
+        "templates/text_offsets.asm": [],
+        "templates/text2.asm": [("; STARTER_DECK", "starter_deck_name")],
+        "templates/text3.asm": [("; NPC_NAMES:", "npc_name"), ("; STARTER_DECK", "starter_deck_name")],
+        "templates/text4.asm": [("; MITCH_CHECK:", "mitch_check")],
+        "templates/text5.asm": [],
+        "templates/text6.asm": [],
+        "templates/text7.asm": [("; ISAAC_CHECK:", "isaac_check")],
+        "templates/text8.asm": [],
+        "templates/text9.asm": [],
+        "templates/patches/isaac_check.asm": [],
+        "templates/patches/ken_check.asm": [],
+        "templates/patches/mitch_check.asm": [],
+        "templates/patches/murray_check.asm": [],
+    }
+
     def __init__(self):
         self.seed = 1
         self.data = None
+        self.data_files = []
+        self.inputs_hash = None
+        self.build_hash = None
+        self.cards_template = None
+        self.attack_pools = None
+        self.templates = {}
+        self.template_cache = None
+
+        # Build tree the randomized sources are written into
+        self.output_dir = "."
+        self.write_outputs = True
+        self.rendered = {}
+        self.written = {}
+
+        # Fixed-size fields of the last render, used by the direct ROM patching mode
+        self.fields = None
+        self.constants = None
+
+        # Profiler timing each phase when running with --profile
+        self.profiler = None
+
+        # make is killed after build_timeout seconds, its output is echoed live with stream_output
+        self.build_timeout = None
+        self.stream_output = False
+        # Jobs make runs at once, the objects a seed rebuilds are independent and assemble in parallel
+        self.make_jobs = 1
 
         # CARDS
         # Groups evolutioary lines in the same boosters
@@ -139,6 +1127,7 @@ class PTCGRando:
         return filter(lambda x: ("COLORLESS" in x["energy"], len(x["energy"])) == (True, 1), cards)
 
     def load_data(self, data_file, cards_file, npcs_file):
+        self.data_files = [data_file, cards_file, npcs_file]
         with open_utf8(data_file) as file:
             self.data = json.load(file)
         with open_utf8(cards_file) as file:
@@ -147,377 +1136,307 @@ class PTCGRando:
             self.data["pokemon_cards"] = list(filter(lambda x: x["type"] == PTCGRando.TYPE_PKMN, card_list))
             self.data["energy_cards"] = list(filter(lambda x: x["type"] == PTCGRando.TYPE_ENERGY, card_list))
             self.data["trainer_cards"] = list(filter(lambda x: x["type"] == PTCGRando.TYPE_TRAINER, card_list))
+        self.build_card_indexes()
         with open_utf8(npcs_file) as file:
             self.data["npcs"] = json.load(file)
 
+    # Templates are compiled once and kept for every seed generated by this instance
+    def get_template(self, path):
+        if path not in self.templates:
+            markers = PTCGRando.TEMPLATES[path]
+            if self.template_cache is not None:
+                chunks = self.template_cache.get(path, lambda lines: CompiledTemplate.compile(lines, markers), depends=markers)
+            else:
+                with open_utf8(path, "r") as src:
+                    chunks = CompiledTemplate.compile(src.readlines(), markers)
+            self.templates[path] = CompiledTemplate(chunks)
+        return self.templates[path]
+
+    def get_cards_template(self):
+        if self.cards_template is None:
+            path = "templates/cards.asm"
+            if self.template_cache is not None:
+                state = self.template_cache.get(path, lambda lines: CardsTemplate(lines).get_state())
+                self.cards_template = CardsTemplate.from_state(state)
+            else:
+                with open_utf8(path, "r") as src:
+                    self.cards_template = CardsTemplate(src.readlines())
+        return self.cards_template
+
+    def open_output(self, path):
+        return OutputFile(self, path)
+
+    def phase(self, name):
+        return profile_phase(self.profiler, name)
+
+    # Fields are recorded while self.fields is a list, each one preceded by a marker label so a
+    # reference build's sym file gives its ROM offset (see RomPatcher). line may span several lines,
+    # values are its bytes from offset on. Only text fields may change size between seeds.
+    def field_line(self, line, values, offset=0, text=False):
+        if self.fields is None:
+            return line
+
+        self.fields.append((values, offset, text))
+        return FIELD_LABEL.format(len(self.fields) - 1, line.count("\n")) + line
+
+    def text_line(self, line):
+        return self.field_line(line, text_values(line), text=True)
+
+    # Hash of everything besides the seed and options a patch is generated from
+    def get_inputs_hash(self):
+        if self.inputs_hash is None:
+            inputs = hashlib.sha256()
+            for path in [os.path.abspath(__file__), "templates/cards.asm"] + self.data_files + list(PTCGRando.TEMPLATES):
+                with open(path, "rb") as file:
+                    inputs.update(file.read())
+            self.inputs_hash = inputs.hexdigest()
+        return self.inputs_hash
+
+    # Patch cache key of a seed with the current options and build inputs
+    def cache_key(self, seed):
+        options = {option: getattr(self, option) for option in PTCGRando.OPTIONS}
+        key = json.dumps([seed, options, self.get_inputs_hash(), self.get_build_hash()], sort_keys=True)
+        return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    # Hash of the rendered sources without their fields, seeds sharing it share a ROM layout
+    def layout_hash(self):
+        layout = hashlib.sha1()
+        for path in sorted(self.rendered):
+            layout.update(path.encode("utf8"))
+            layout.update(mask_fields(self.rendered[path]).encode("utf8"))
+        return layout.hexdigest()
+
+    # Hash of what make builds the ROM from besides the randomized sources: the other sources, the base
+    # ROM, the Makefiles and the RGBDS tools on PATH
+    def get_build_hash(self):
+        if self.build_hash is None:
+            build = hashlib.sha1()
+            paths = ["Makefile", "baserom.gbc"]
+            for top in ["src", "tools"]:
+                for root, dirs, files in os.walk(top):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name == "Makefile" or os.path.splitext(name)[1] in PTCGRando.BUILD_SOURCES:
+                            paths.append(os.path.join(root, name))
+            for path in paths:
+                if path in PTCGRando.OUTPUTS or not os.path.exists(path):
+                    continue
+                build.update(path.encode("utf8"))
+                with open(path, "rb") as file:
+                    build.update(hashlib.sha1(file.read()).digest())
+            for tool in ["rgbasm", "rgblink", "rgbfix", "rgbgfx"]:
+                tool_path = shutil.which(tool)
+                if tool_path is not None:
+                    stat = os.stat(tool_path)
+                    build.update("{} {} {}".format(tool_path, stat.st_size, stat.st_mtime_ns).encode("utf8"))
+            self.build_hash = build.hexdigest()
+        return self.build_hash
+
+    # Reference ROM directory of the current layout, built from the current build inputs
+    def reference_key(self):
+        return hashlib.sha1((self.get_build_hash() + self.layout_hash()).encode("utf8")).hexdigest()
+
+    def load_templates(self, cache_file=None):
+        if cache_file is not None:
+            self.template_cache = TemplateCache(cache_file)
+
+        self.get_cards_template()
+        for path in PTCGRando.TEMPLATES:
+            self.get_template(path)
+
+        if self.template_cache is not None:
+            self.template_cache.save()
+
+    # Precomputed lookups so card queries during generation are dict hits instead of list scans
+    def build_card_indexes(self):
+        # self.data["cards"] is already keyed by card name
+        # Several cards share a text_name (Pikachu1-4, ...), keep the first one like a linear search would
+        self.data["cards_by_text_name"] = {}
+        for card in self.data["cards"].values():
+            self.data["cards_by_text_name"].setdefault(card["text_name"], card)
+
+        # Pre-evolution text_name -> pokemon evolving from it, in card order
+        self.data["evolutions"] = {}
+        for card in self.data["pokemon_cards"]:
+            if card["target_group"]:
+                self.data["evolutions"].setdefault(card["target_group"], []).append(card)
+
+        self.data["pokemon_by_color"] = {color: [] for color in self.data["colors"]}
+        for card in self.data["pokemon_cards"]:
+            self.data["pokemon_by_color"].setdefault(card["card_group"], []).append(card)
+
+        # Number of evolutions following each pokemon, through the first evolution of each stage
+        self.data["evolution_depth"] = {}
+        for card in self.data["pokemon_cards"]:
+            depth = 0
+            evolution = card
+            while depth < 2 and evolution["text_name"] in self.data["evolutions"]:
+                evolution = self.data["evolutions"][evolution["text_name"]][0]
+                depth += 1
+            self.data["evolution_depth"][card["name"]] = depth
+
+    # Evolution type of a parsed card, used to pick its hp, retreat cost and attack pool
+    def get_evolution_type(self, card_template):
+        depth = self.data["evolution_depth"].get(card_template.name)
+        if depth is None or not card_template.is_pokemon():
+            return PokemonEvolutionType.BASIC_NO_EVOLUTION
+
+        if card_template.stage == "BASIC":
+            if depth == 2:
+                return PokemonEvolutionType.BASIC_TWO_EVOLUTION
+            elif depth == 1:
+                return PokemonEvolutionType.BASIC_ONE_EVOLUTION
+            return PokemonEvolutionType.BASIC_NO_EVOLUTION
+        elif card_template.stage == "STAGE1":
+            if depth:
+                return PokemonEvolutionType.EVO1_TWO_EVOLUTION
+            return PokemonEvolutionType.EVO1_ONE_EVOLUTION
+        return PokemonEvolutionType.EVO2_TWO_EVOLUTION
+
+    # Attack records of the cards template, parsed on first use
+    def get_attack_pools(self):
+        if self.attack_pools is None:
+            cards_template = self.get_cards_template()
+            evolution_types = [self.get_evolution_type(card) for card in cards_template.cards]
+            self.attack_pools = AttackPools(cards_template, evolution_types)
+        return self.attack_pools
+
     # Randomize each card (hp, attacks, weakness, etc.)
     def randomize_cards(self):
         # {
-        current_card = ""
-        with open_utf8("templates/cards.asm", "r") as src, open_utf8("src/data/cards.asm", "w") as target:
-            lines = src.readlines()
-
-            default_attack = [None, None, None, None, None, None]
-            default_attack[
-                PokemonEvolutionType.BASIC_NO_EVOLUTION
-            ] = """\tenergy COLORLESS, 1 ; energies
-                \ttx TackleName ; name
-                \tdw NONE ; description
-                \tdw NONE ; description (cont)
-                \tdb 10 ; damage
-                \tdb DAMAGE_NORMAL ; category
-                \tdw NONE ; effect commands
-                \tdb NONE ; flags 1
-                \tdb NONE ; flags 2
-                \tdb NONE ; flags 3
-                \tdb 0
-                \tdb ATK_ANIM_HIT ; animation"""
-
-            default_attack[PokemonEvolutionType.BASIC_ONE_EVOLUTION] = default_attack[
-                PokemonEvolutionType.BASIC_NO_EVOLUTION
-            ]
-            default_attack[PokemonEvolutionType.BASIC_TWO_EVOLUTION] = default_attack[
-                PokemonEvolutionType.BASIC_NO_EVOLUTION
-            ]
-
-            default_attack[
-                PokemonEvolutionType.EVO1_ONE_EVOLUTION
-            ] = """\tenergy COLORLESS, 2 ; energies
-                \ttx PoundName ; name
-                \tdw NONE ; description
-                \tdw NONE ; description (cont)
-                \tdb 20 ; damage
-                \tdb DAMAGE_NORMAL ; category
-                \tdw NONE ; effect commands
-                \tdb NONE ; flags 1
-                \tdb NONE ; flags 2
-                \tdb NONE ; flags 3
-                \tdb 0
-                \tdb ATK_ANIM_HIT ; animation"""
-
-            default_attack[PokemonEvolutionType.EVO1_TWO_EVOLUTION] = default_attack[
-                PokemonEvolutionType.BASIC_NO_EVOLUTION
-            ]
-
-            default_attack[
-                PokemonEvolutionType.EVO2_TWO_EVOLUTION
-            ] = """\tenergy COLORLESS, 3 ; energies
-                \ttx SlashName ; name
-                \tdw NONE ; description
-                \tdw NONE ; description (cont)
-                \tdb 20 ; damage
-                \tdb DAMAGE_NORMAL ; category
-                \tdw NONE ; effect commands
-                \tdb NONE ; flags 1
-                \tdb NONE ; flags 2
-                \tdb NONE ; flags 3
-                \tdb 0
-                \tdb ATK_ANIM_SLASH ; animation"""
+        self.get_attack_pools()
+
+        with self.phase("randomize_cards.collect_attacks"):
+            damage_order, non_damage_order = self.collect_attacks()
+
+        with self.phase("randomize_cards.rewrite"):
+            self.rewrite_cards(damage_order, non_damage_order)
+
+    # Order the damage and non damage attacks of each evolution type are drawn in
+    def collect_attacks(self):
+        damage_order = []
+        non_damage_order = []
+
+        # One noise stream per attack pool
+        for i in PokemonEvolutionType:
+            damage_stream = NoiseStream(PTCGRando.RAND_ATTACKS, i * 10 + 1, self.seed)
+            damage_order.append(attack_order(len(self.attack_pools.damage[i]), damage_stream))
+
+            non_damage_stream = NoiseStream(PTCGRando.RAND_ATTACKS, i * 10 + 2, self.seed)
+            non_damage_order.append(attack_order(len(self.attack_pools.non_damage[i]), non_damage_stream))
+
+        return damage_order, non_damage_order
+
+    # Writes the cards with their randomized fields and attacks drawn from the pools
+    def rewrite_cards(self, damage_order, non_damage_order):
+        default_attack = [TACKLE, TACKLE, POUND, TACKLE, TACKLE, SLASH]
+        pools = self.attack_pools
+
+        # Rewrite the randomized fields over a copy of the template lines
+        lines = self.cards_template.lines.copy()
+        for card, pokemon_evolution_type, card_attacks in zip(
+            self.cards_template.cards, pools.evolution_types, pools.card_attacks
+        ):
+            if card.set is not None:
+                y = (
+                    self.data["cards"][card.name]["group"]
+                    if self.group_by_evolution
+                    else self.data["cards"][card.name]["id"]
+                )
+                y *= 10
+                noise = noise2d(PTCGRando.RAND_CARDS, y, self.seed)
+                card_set = pick(self.data["sets"], noise)
+                lines[card.set] = self.field_line("	db %s | NONE ; sets\n" % card_set, [card_set + " | NONE"])
+
+            # Randomize hp according to evolution
+            if card.hp is not None:
+                y += 10
+                noise = noise2d(PTCGRando.RAND_CARDS, y, self.seed)
 
-            damage_attacks = [list(), list(), list(), list(), list(), list()]
-            non_damage_attacks = [list(), list(), list(), list(), list(), list()]
-
-            # Read all attacks
-            i = 0
-            while i < len(lines):
-                line = lines[i]
-
-                if "CARD_NAME" in line:
-                    current_card = line.split(":")[0]
-                    current_type = lines[i + 1].split(" ")[1][10:]
-
-                    pokemon_evolution_type = PokemonEvolutionType.BASIC_NO_EVOLUTION
-
-                    card = list(
-                        filter(
-                            lambda x: x["name"] == current_card,
-                            self.data["pokemon_cards"],
-                        )
-                    )
-                    if card and "TYPE_PKMN" in lines[i + 1]:
-                        evo1 = list(
-                            filter(
-                                lambda x: x["target_group"] == card[0]["text_name"],
-                                self.data["pokemon_cards"],
-                            )
-                        )
-
-                        evo2 = ""
-                        if evo1:
-                            evo2 = list(
-                                filter(
-                                    lambda x: x["target_group"] == evo1[0]["text_name"],
-                                    self.data["pokemon_cards"],
-                                )
-                            )
-
-                        stage_line = lines[i + 8]
-                        if "BASIC" in stage_line:
-                            if evo1 and evo2:
-                                pokemon_evolution_type = PokemonEvolutionType.BASIC_TWO_EVOLUTION
-                            elif evo1:
-                                pokemon_evolution_type = PokemonEvolutionType.BASIC_ONE_EVOLUTION
-                        elif "STAGE1" in stage_line:
-                            if evo1:
-                                pokemon_evolution_type = PokemonEvolutionType.EVO1_TWO_EVOLUTION
-                            else:
-                                pokemon_evolution_type = PokemonEvolutionType.EVO1_ONE_EVOLUTION
-                        else:
-                            pokemon_evolution_type = PokemonEvolutionType.EVO2_TWO_EVOLUTION
+                hp_mins = [50, 40, 60, 40, 60, 70]
+                hp_maxs = [70, 50, 80, 50, 70, 100]
 
-                # Add each non empty attack to list according to pokemon evolution to be shuffled around
-                if "; attack" in line:
-                    attack = ""
+                hp_min = hp_mins[pokemon_evolution_type]
+                hp_max = hp_maxs[pokemon_evolution_type]
+                hp = calc_range(noise, hp_min, hp_max)
+                hp = round(hp, -1)
 
-                    # Don't save the ; attack # here
-                    i += 1
-                    line = lines[i]
+                lines[card.hp] = self.field_line("	db %s ; hp\n" % hp, [hp])
 
-                    is_valid_attack = True
-                    while line != "\n":
-                        if "NONE ; name" in line:
-                            is_valid_attack = False
+            # Remove weakness
+            if card.weakness is not None:
+                lines[card.weakness] = self.field_line("	db NONE ; weakness\n", ["NONE"])
 
-                        attack += line
-                        i += 1
-                        line = lines[i]
+            # Remove resistances
+            if card.resistance is not None:
+                lines[card.resistance] = self.field_line("	db NONE ; resistance\n", ["NONE"])
 
-                    if is_valid_attack:
-                        power = attack.split(";")[4].split(" ")[3]
-                        if power == "0":
-                            non_damage_attacks[pokemon_evolution_type].append(attack)
+            # Randomize retreat cost according to evolution
+            if card.retreat_cost is not None:
+                y += 10
+                noise = noise2d(PTCGRando.RAND_CARDS, y, self.seed)
+
+                retreat_cost_mins = [1, 0, 1, 0, 1, 2]
+                retreat_cost_maxs = [3, 1, 3, 1, 2, 3]
+
+                retreat_cost_min = retreat_cost_mins[pokemon_evolution_type]
+                retreat_cost_max = retreat_cost_maxs[pokemon_evolution_type]
+                retreat_cost = calc_range(noise, retreat_cost_min, retreat_cost_max)
+
+                lines[card.retreat_cost] = self.field_line("	db %s ; retreat cost\n" % retreat_cost, [retreat_cost])
+
+            # Randomize attacks by shuffling between pokemon of same evolution stage
+            if card.attacks:
+                attack1 = None
+                attack2 = None
+
+                for attack in card_attacks:
+                    if attack.name is None:
+                        # Empty attack written as is
+                        if attack1 is not None:
+                            attack2 = attack
+
+                            # Force a weak base attack per evolution type if Pokemon has no attack with power.
+                            # It goes first unless attack1 is cheaper, only counting the last energy
+                            # amount of attack1 like the text parsing used to, so seeds don't change.
+                            if attack1.damage == 0:
+                                attack2 = default_attack[pokemon_evolution_type]
+                                cost1 = attack1.energies[-1][1] if attack1.energies else 0
+                                if cost1 >= attack2.cost:
+                                    attack1, attack2 = attack2, attack1
                         else:
-                            damage_attacks[pokemon_evolution_type].append(attack)
-
-                i += 1
-
-            # Ensure at least one damage and non damage attack per pokemon
-            for i in PokemonEvolutionType:
-                while len(damage_attacks[i]) < 300:
-                    random.shuffle(damage_attacks[i])
-                    damage_attacks[i].extend(damage_attacks[i])
-
-                while len(non_damage_attacks[i]) < 300:
-                    random.shuffle(non_damage_attacks[i])
-                    non_damage_attacks[i].extend(non_damage_attacks[i])
-
-            # Shuffle all attacks
-            for i in PokemonEvolutionType:
-                random.shuffle(non_damage_attacks[i])
-                random.shuffle(damage_attacks[i])
-
-            i = 0
-            while i < len(lines):
-                line = lines[i]
-
-                # Get card name to
-                if "CARD_NAME" in line:
-                    current_card = line.split(":")[0]
-                    current_type = lines[i + 1].split(" ")[1][10:]
-
-                    pokemon_evolution_type = PokemonEvolutionType.BASIC_NO_EVOLUTION
-
-                    card = list(
-                        filter(
-                            lambda x: x["name"] == current_card,
-                            self.data["pokemon_cards"],
-                        )
-                    )
-                    if card and "TYPE_PKMN" in lines[i + 1]:
-                        evo1 = list(
-                            filter(
-                                lambda x: x["target_group"] == card[0]["text_name"],
-                                self.data["pokemon_cards"],
-                            )
-                        )
-
-                        evo2 = ""
-                        if evo1:
-                            evo2 = list(
-                                filter(
-                                    lambda x: x["target_group"] == evo1[0]["text_name"],
-                                    self.data["pokemon_cards"],
-                                )
-                            )
-
-                        stage_line = lines[i + 8]
-                        if "BASIC" in stage_line:
-                            if evo1 and evo2:
-                                pokemon_evolution_type = PokemonEvolutionType.BASIC_TWO_EVOLUTION
-                            elif evo1:
-                                pokemon_evolution_type = PokemonEvolutionType.BASIC_ONE_EVOLUTION
-                        elif "STAGE1" in stage_line:
-                            if evo1:
-                                pokemon_evolution_type = PokemonEvolutionType.EVO1_TWO_EVOLUTION
-                            else:
-                                pokemon_evolution_type = PokemonEvolutionType.EVO1_ONE_EVOLUTION
+                            attack1 = attack
+                    else:
+                        # Get an unique random attack
+                        if attack1 is not None:
+                            damage = attack1.damage == 0
                         else:
-                            pokemon_evolution_type = PokemonEvolutionType.EVO2_TWO_EVOLUTION
-
-                    target.write(line)
-
-                elif "RANDOMIZE_RARITY" in line:
-                    # @Todo add rarity randomizing?
-                    target.write(line)
-
-                elif "RANDOMIZE_SET" in line:
-                    y = (
-                        self.data["cards"][current_card]["group"]
-                        if self.group_by_evolution
-                        else self.data["cards"][current_card]["id"]
-                    )
-                    y *= 10
-                    noise = noise2d(PTCGRando.RAND_CARDS, y, self.seed)
-                    target.write("	db %s | NONE ; sets\n" % pick(self.data["sets"], noise))
-
-                # Randomize hp according to evolution
-                elif "; hp" in line:
-                    y += 10
-                    noise = noise2d(PTCGRando.RAND_CARDS, y, self.seed)
-
-                    hp_mins = [50, 40, 60, 40, 60, 70]
-                    hp_maxs = [70, 50, 80, 50, 70, 100]
-
-                    hp_min = hp_mins[pokemon_evolution_type]
-                    hp_max = hp_maxs[pokemon_evolution_type]
-                    hp = calc_range(noise, hp_min, hp_max)
-                    hp = round(hp, -1)
-
-                    target.write("	db %s ; hp\n" % hp)
-
-                # Remove weakness
-                elif "; weakness" in line:
-                    target.write("	db NONE ; weakness\n")
-
-                # Remove resistances
-                elif "; resistance" in line:
-                    target.write("	db NONE ; resistance\n")
-
-                # Randomize retreat cost according to evolution
-                elif "; retreat cost" in line:
-                    y += 10
-                    noise = noise2d(PTCGRando.RAND_CARDS, y, self.seed)
-
-                    retreat_cost_mins = [1, 0, 1, 0, 1, 2]
-                    retreat_cost_maxs = [3, 1, 3, 1, 2, 3]
-
-                    retreat_cost_min = retreat_cost_mins[pokemon_evolution_type]
-                    retreat_cost_max = retreat_cost_maxs[pokemon_evolution_type]
-                    retreat_cost = calc_range(noise, retreat_cost_min, retreat_cost_max)
-
-                    target.write("	db %s ; retreat cost\n" % retreat_cost)
-
-                # Randomize attacks by shuffling between pokemon of same evolution stage
-                elif "; attack" in line:
-                    attack1 = ""
-                    attack2 = ""
-
-                    while not attack2:
-                        attack = ""
-
-                        attack_name = lines[i + 2]
-                        if "NONE ; name" in attack_name:
-                            # Empty attack write lines as is
-                            while line != "\n":
-                                i += 1
-                                line = lines[i]
-                                attack += line
-
-                            if attack1:
-                                attack2 = attack
-
-                                # Force a weak base attack per evolution type if Pokemon has no attack with power
-                                power1 = attack1.split(";")[4].split(" ")[3]
-                                if power1 == "0":
-                                    attack2 = default_attack[pokemon_evolution_type]
-
-                                    cost1 = 0
-                                    for digit in attack1.split(";")[0].split(" "):
-                                        if digit.isdigit():
-                                            cost1 += int(digit)
-
-                                    cost2 = 0
-                                    for digit in attack2.split(";")[0].split(" "):
-                                        if digit.isdigit():
-                                            cost2 += int(digit)
-
-                                    power1 = attack1.split(";")[4].split(" ")[3]
-                                    power2 = attack2.split(";")[4].split(" ")[3]
-
-                                    if cost1 > cost2 or (cost1 == cost2 and power1 > power2):
-                                        attack1, attack2 = attack2, attack1
-                            else:
-                                attack1 = attack
-                                i += 1
-                                line = lines[i]
+                            noise = noise2d(PTCGRando.RAND_ATTACKS, self.data["cards"][card.name]["id"] * 10, self.seed)
+                            damage = chance(noise, 0.7)
+
+                        if damage:
+                            attack = pools.damage[pokemon_evolution_type][damage_order[pokemon_evolution_type].pop()]
                         else:
-                            # Get an unique random attack
-                            if attack1:
-                                power1 = attack1.split(";")[4].split(" ")[3]
-                                if power1 == "0":
-                                    attack = damage_attacks[pokemon_evolution_type].pop()
-                                else:
-                                    attack = non_damage_attacks[pokemon_evolution_type].pop()
-                            else:
-                                if random.random() < 0.7:
-                                    attack = damage_attacks[pokemon_evolution_type].pop()
-                                else:
-                                    attack = non_damage_attacks[pokemon_evolution_type].pop()
-
-                            # Replace energy same as pokemon type, colorless keep energy of original attack
-                            for energy in [
-                                "GRASS,",
-                                "FIRE,",
-                                "WATER,",
-                                "LIGHTNING,",
-                                "FIGHTING,",
-                                "PSYCHIC,",
-                            ]:
-                                if energy in attack:
-                                    attack = attack.replace(energy, current_type + ",")
-                                    break
-
-                            # Skip actual attack lines
-                            while line != "\n":
-                                i += 1
-                                line = lines[i]
-
-                            if attack1:
-                                attack2 = attack
-
-                                cost1 = 0
-                                for digit in attack1.split(";")[0].split(" "):
-                                    if digit[:1].isdigit():
-                                        cost1 += int(digit[:1])
-
-                                cost2 = 0
-                                for digit in attack2.split(";")[0].split(" "):
-                                    if digit[:1].isdigit():
-                                        cost2 += int(digit[:1])
-
-                                power1 = attack1.split(";")[4].split(" ")[3]
-                                power2 = attack2.split(";")[4].split(" ")[3]
-
-                                if cost1 > cost2 or (cost1 == cost2 and power1 > power2):
-                                    attack1, attack2 = attack2, attack1
-                            else:
-                                attack1 = attack
-                                i += 1
-                                line = lines[i]
-
-                    # Write ; attack #
-                    target.write("\t; attack 1\n")
-                    target.write(attack1)
-                    target.write("\n")
-                    target.write("\t; attack 2\n")
-                    target.write(attack2)
-                    target.write("\n")
-
-                # Keep all other lines
-                else:
-                    target.write(line)
+                            attack = pools.non_damage[pokemon_evolution_type][non_damage_order[pokemon_evolution_type].pop()]
 
-                i += 1
+                        if attack1 is not None:
+                            attack1, attack2 = order_attacks(attack1, attack)
+                        else:
+                            attack1 = attack
+
+                # Replace the whole attack block, ; attack # included. Energies same as pokemon type,
+                # colorless keep energy of original attack
+                # The attacks are fixed-size, the whole block is a field
+                text1 = attack1.render(card.color()) + ("\n" if attack1.name is None else "")
+                text2 = attack2.render(card.color()) + ("\n" if attack2.name is None else "")
+                block = "\t; attack 1\n" + text1 + "\n" + "\t; attack 2\n" + text2 + "\n"
+                values = attack1.field_values(card.color()) + attack2.field_values(card.color())
+                lines[card.attacks_start] = self.field_line(block, values)
+                for i in range(card.attacks_start + 1, card.attacks_end):
+                    lines[i] = ""
+
+        with self.open_output("src/data/cards.asm") as target:
+            target.write("".join(lines))
 
     # Generate trainer duels (booster prizes, trainer decks used and music)
     def write_duel(self, target, line):
@@ -547,7 +1466,9 @@ class PTCGRando:
             noise = noise3d(PTCGRando.RAND_NPC_DECKS, y, 30, self.seed)
             music_id = pick(self.data["music"], noise)
 
-        target.write("	start_duel PRIZES_{}, {}, {}\n".format(prize, deck_id, music_id))
+        # Skip the run_command byte, the 3 arguments are the fixed-size field
+        line = "	start_duel PRIZES_{}, {}, {}\n".format(prize, deck_id, music_id)
+        target.write(self.field_line(line, ["PRIZES_{}".format(prize), deck_id, music_id], 1))
 
     # Generate which random booster prizes are awarded by trainers
     def write_boosters(self, target, line):
@@ -585,20 +1506,22 @@ class PTCGRando:
             while len(boosters) >= 3:
                 booster_set = boosters[:3]
                 boosters = boosters[3:]
-                target.write("	give_booster_packs {}\n".format(", ".join(booster_set)))
+                line = "	give_booster_packs {}\n".format(", ".join(booster_set))
+                target.write(self.field_line(line, booster_set, 1))
 
     def write_master_check(self, target, line):
         if len(self.data["master_checks"]) == 0:
+            target.write(line)
             return
 
         noise = noise2d(PTCGRando.RAND_MASTERS, self.data["masters_checked"], self.seed)
         patch_file = pick(self.data["master_checks"], noise)
         self.data["master_checks"].remove(patch_file)
 
-        with open_utf8(patch_file, "r") as patch:
-            target.writelines(patch.readlines())
+        self.get_template(patch_file).render(target)
 
         self.data["masters_checked"] = self.data["masters_checked"] + 10
+        target.write(line)
 
     def randomize_bank03(self):
         self.data["master_checks"] = [
@@ -608,27 +1531,21 @@ class PTCGRando:
             "templates/patches/murray_check.asm",
         ]
         self.data["masters_checked"] = 0
-        with open_utf8("templates/bank03.asm", "r") as src, open_utf8("src/engine/bank03.asm", "w") as target:
-            for i, line in enumerate(src):
-                if "; DUEL:" in line:
-                    self.write_duel(target, line)
-                elif "; BOOSTERS:" in line:
-                    self.write_boosters(target, line)
-                elif "; MASTER_CHECK:" in line:
-                    self.write_master_check(target, line)
-                    target.write(line)
-                else:
-                    target.write(line)
+        hooks = {
+            "duel": self.write_duel,
+            "boosters": self.write_boosters,
+            "master_check": self.write_master_check,
+        }
+        with self.open_output("src/engine/bank03.asm") as target:
+            self.get_template("templates/bank03.asm").render(target, hooks)
 
     def randomize_bank04(self):
-        with open_utf8("templates/bank04.asm", "r") as src, open_utf8("src/engine/bank04.asm", "w") as target:
-            for i, line in enumerate(src):
-                target.write(line)
+        with self.open_output("src/engine/bank04.asm") as target:
+            self.get_template("templates/bank04.asm").render(target)
 
     def randomize_home(self):
-        with open_utf8("templates/home.asm", "r") as src, open_utf8("src/engine/home.asm", "w") as target:
-            for i, line in enumerate(src):
-                target.write(line)
+        with self.open_output("src/engine/home.asm") as target:
+            self.get_template("templates/home.asm").render(target)
 
     # Generates a single base player deck
     def generate_starter_deck(self, target, z, deck_name):
@@ -639,13 +1556,14 @@ class PTCGRando:
         noise = noise3d(PTCGRando.RAND_STARTER_DECKS, y, z, self.seed)
         remaining_trainer_cards = calc_range(noise, self.min_trainer, self.max_trainer)
 
-        while remaining_trainer_cards > 0:
+        trainers = CapacitySampler(self.data["trainer_cards"], cards)
+        while remaining_trainer_cards > 0 and trainers.total() > 0:
             y += 10
             noise = noise3d(PTCGRando.RAND_STARTER_DECKS, y, z, self.seed)
-            card = pick(self.data["trainer_cards"], noise)
-            if cards[card["constant"]] < card["limit"]:
-                cards[card["constant"]] += 1
-                remaining_trainer_cards -= 1
+            card = trainers.draw(noise)
+            cards[card["constant"]] += 1
+            trainers.take(card)
+            remaining_trainer_cards -= 1
 
         # Force start with 2 Mysterious Fossil, so Fossil pokemon are sort of playable
         cards["MYSTERIOUS_FOSSIL"] = 2
@@ -657,7 +1575,7 @@ class PTCGRando:
 
         # Generate deck colors
         self.remaining_deck_colors = self.data["colors"].copy()
-        random.shuffle(self.remaining_deck_colors)
+        NoiseStream(PTCGRando.RAND_STARTER_COLORS, z, self.seed).shuffle(self.remaining_deck_colors)
         colors = self.remaining_deck_colors[:color_count]
 
         # Name deck according to up to 3 first deck colors
@@ -672,39 +1590,31 @@ class PTCGRando:
             max = self.max_pokemon / len(colors)
             remaining_pokemon_cards = calc_range(noise, min, max)
 
-            pokemons = list(PTCGRando.pkmn_by_energy(self.data["pokemon_cards"], color))
-            while remaining_pokemon_cards > 0:
+            pokemons = CapacitySampler(self.data["pokemon_by_color"][color], cards)
+            while remaining_pokemon_cards > 0 and pokemons.total() > 0:
                 y += 10
                 noise = noise3d(PTCGRando.RAND_STARTER_DECKS, y, z, self.seed)
-                card = pick(pokemons, noise)
-
-                if cards[card["constant"]] < card["limit"]:
-                    cards[card["constant"]] += 1
-                    remaining_pokemon_cards -= 1
-
-                    if card["has_evolution"] and card["target_group"]:
-                        pre_evo = next(
-                            filter(
-                                lambda x: x["text_name"] == card["target_group"],
-                                self.data["cards"].values(),
-                            )
-                        )
-
-                        if cards[pre_evo["constant"]] < pre_evo["limit"]:
-                            cards[pre_evo["constant"]] += 1
-                            remaining_pokemon_cards -= 1
+                card = pokemons.draw(noise)
+
+                cards[card["constant"]] += 1
+                pokemons.take(card)
+                remaining_pokemon_cards -= 1
 
-                        if pre_evo["has_evolution"] and pre_evo["target_group"]:
-                            pre_evo2 = next(
-                                filter(
-                                    lambda x: x["text_name"] == pre_evo["target_group"],
-                                    self.data["cards"].values(),
-                                )
-                            )
+                if card["has_evolution"] and card["target_group"]:
+                    pre_evo = self.data["cards_by_text_name"][card["target_group"]]
 
-                            if cards[pre_evo2["constant"]] < pre_evo2["limit"]:
-                                cards[pre_evo2["constant"]] += 1
-                                remaining_pokemon_cards -= 1
+                    if cards[pre_evo["constant"]] < pre_evo["limit"]:
+                        cards[pre_evo["constant"]] += 1
+                        pokemons.take(pre_evo)
+                        remaining_pokemon_cards -= 1
+
+                    if pre_evo["has_evolution"] and pre_evo["target_group"]:
+                        pre_evo2 = self.data["cards_by_text_name"][pre_evo["target_group"]]
+
+                        if cards[pre_evo2["constant"]] < pre_evo2["limit"]:
+                            cards[pre_evo2["constant"]] += 1
+                            pokemons.take(pre_evo2)
+                            remaining_pokemon_cards -= 1
 
         # Add enegies to fill deck
         energies = []
@@ -712,157 +1622,171 @@ class PTCGRando:
             energies.append(self.data["cards"][self.data["energies"][color]])
         remaining_energies = 60 - sum(cards.values())
 
-        while remaining_energies > 0:
+        energies = CapacitySampler(energies, cards)
+        while remaining_energies > 0 and energies.total() > 0:
             y += 10
             noise = noise3d(PTCGRando.RAND_STARTER_DECKS, y, z, self.seed)
-            card = pick(energies, noise)
-            if cards[card["constant"]] < card["limit"]:
-                cards[card["constant"]] += 1
-                remaining_energies -= 1
+            card = energies.draw(noise)
+            cards[card["constant"]] += 1
+            energies.take(card)
+            remaining_energies -= 1
+
+        self.write_starter_deck_entries(target, cards)
+
+    # Writes the cards of a starter deck as STARTER_DECK_ENTRIES (count, card) entries when they can be
+    def write_starter_deck_entries(self, target, cards):
+        entries = [(count, card) for card, count in cards.items()]
+        if len(entries) > PTCGRando.STARTER_DECK_ENTRIES or sum(cards.values()) < PTCGRando.STARTER_DECK_ENTRIES:
+            for count, card in entries:
+                target.write("	db {}, {}\n".format(count, card))
+            return
 
-        for k in cards:
-            target.write("	db {}, {}\n".format(cards[k], k))
+        # Split copies off into entries of their own, like the duplicate entries of the vanilla decks,
+        # so the size of the deck doesn't change between seeds
+        split = PTCGRando.STARTER_DECK_ENTRIES - len(entries)
+        lines = []
+        values = []
+        for count, card in entries:
+            copies = min(count - 1, split)
+            split -= copies
+            for entry in [(1, card)] * copies + [(count - copies, card)]:
+                lines.append("	db {}, {}\n".format(*entry))
+                values.extend(entry)
+        target.write(self.field_line("".join(lines), values))
+
+    def write_starter_deck(self, target, line):
+        self.generate_starter_deck(target, self.data["starter_decks_generated"], line.split(":")[1].strip())
+        self.data["starter_decks_generated"] = self.data["starter_decks_generated"] + 10
+        target.write(line)
 
     def randomize_decks(self):
-        with open_utf8("templates/decks.asm", "r") as src, open_utf8("src/data/decks.asm", "w") as target:
-            z = 10
-            for i, line in enumerate(src):
-                if "; GENERATE_DECK:" in line:
-                    self.generate_starter_deck(target, z, line.split(":")[1].strip())
-                    z += 10
-                target.write(line)
+        self.data["starter_decks_generated"] = 10
+        with self.open_output("src/data/decks.asm") as target:
+            self.get_template("templates/decks.asm").render(target, {"starter_deck": self.write_starter_deck})
 
     def randomize_text_offsets(self):
-        with open_utf8("templates/text_offsets.asm", "r") as src, open_utf8("src/text/text_offsets.asm", "w") as target:
-            for i, line in enumerate(src):
-                target.write(line)
+        with self.open_output("src/text/text_offsets.asm") as target:
+            self.get_template("templates/text_offsets.asm").render(target)
+
+    def write_starter_deck_name(self, target, line):
+        target.write(self.text_line(line.format(**self.data["starter_deck_names"])))
 
     def randomize_text2(self):
-        with open_utf8("templates/text2.asm", "r") as src, open_utf8("src/text/text2.asm", "w") as target:
-            for i, line in enumerate(src):
-                if "; STARTER_DECK" in line:
-                    line = line.format(**self.data["starter_deck_names"])
-                target.write(line)
+        with self.open_output("src/text/text2.asm") as target:
+            self.get_template("templates/text2.asm").render(target, {"starter_deck_name": self.write_starter_deck_name})
+
+    def write_npc_name(self, target, line):
+        if self.exclude_npcs:
+            target.write(line.split(":")[1])
+            return
+
+        npcs = self.data["remaining_npcs"]
+        npc = pick(npcs, noise2d(PTCGRando.RAND_NPC_NAMES, self.data["npcs_named"], self.seed))
+        if "Michael" in line:
+            self.data["npc_names"]["Michael"] = npc
+        elif "Chris" in line:
+            self.data["npc_names"]["Chris"] = npc
+        elif "Jessica" in line:
+            self.data["npc_names"]["Jessica"] = npc
+        elif "Jennifer" in line:
+            self.data["npc_names"]["Jennifer"] = npc
+        elif "Nicholas" in line:
+            self.data["npc_names"]["Nicholas"] = npc
+        elif "Brandon" in line:
+            self.data["npc_names"]["Brandon"] = npc
+        npcs.remove(npc)
+        target.write(self.text_line('	text "{}"\n'.format(npc)))
+        self.data["npcs_named"] = self.data["npcs_named"] + 10
 
     def randomize_text3(self):
-        with open_utf8("templates/text3.asm", "r") as src, open_utf8("src/text/text3.asm", "w") as target:
-            y = 10
-            npcs = self.data["npcs"].copy()
-            self.data["npc_names"] = {}
-            for i, line in enumerate(src):
-                if "; NPC_NAMES:" in line:
-                    if self.exclude_npcs:
-                        target.write(line.split(":")[1])
-                    else:
-                        npc = pick(npcs, noise2d(PTCGRando.RAND_NPC_NAMES, y, self.seed))
-                        if "Michael" in line:
-                            self.data["npc_names"]["Michael"] = npc
-                        elif "Chris" in line:
-                            self.data["npc_names"]["Chris"] = npc
-                        elif "Jessica" in line:
-                            self.data["npc_names"]["Jessica"] = npc
-                        elif "Jennifer" in line:
-                            self.data["npc_names"]["Jennifer"] = npc
-                        elif "Nicholas" in line:
-                            self.data["npc_names"]["Nicholas"] = npc
-                        elif "Brandon" in line:
-                            self.data["npc_names"]["Brandon"] = npc
-                        npcs.remove(npc)
-                        target.write('	text "{}"\n'.format(npc))
-                        y += 10
-                elif "; STARTER_DECK" in line:
-                    target.write(line.format(**self.data["starter_deck_names"]))
-                else:
-                    target.write(line)
+        self.data["remaining_npcs"] = self.data["npcs"].copy()
+        self.data["npcs_named"] = 10
+        self.data["npc_names"] = {}
+        hooks = {
+            "npc_name": self.write_npc_name,
+            "starter_deck_name": self.write_starter_deck_name,
+        }
+        with self.open_output("src/text/text3.asm") as target:
+            self.get_template("templates/text3.asm").render(target, hooks)
+
+    def write_mitch_check(self, target, line):
+        npc = ""
+        if self.exclude_npcs:
+            if "Michael" in line:
+                npc = "Michael"
+            elif "Chris" in line:
+                npc = "Chris"
+            elif "Jessica" in line:
+                npc = "Jessica"
+        else:
+            if "Michael" in line:
+                npc = self.data["npc_names"]["Michael"]
+            elif "Chris" in line:
+                npc = self.data["npc_names"]["Chris"]
+            elif "Jessica" in line:
+                npc = self.data["npc_names"]["Jessica"]
+        target.write(self.text_line(line.format(npc)))
 
     def randomize_text4(self):
-        with open_utf8("templates/text4.asm", "r") as src, open_utf8("src/text/text4.asm", "w") as target:
-            for i, line in enumerate(src):
-                if "; MITCH_CHECK:" in line:
-                    npc = ""
-                    if self.exclude_npcs:
-                        if "Michael" in line:
-                            npc = "Michael"
-                        elif "Chris" in line:
-                            npc = "Chris"
-                        elif "Jessica" in line:
-                            npc = "Jessica"
-                    else:
-                        if "Michael" in line:
-                            npc = self.data["npc_names"]["Michael"]
-                        elif "Chris" in line:
-                            npc = self.data["npc_names"]["Chris"]
-                        elif "Jessica" in line:
-                            npc = self.data["npc_names"]["Jessica"]
-                    target.write(line.format(npc))
-                else:
-                    target.write(line)
+        with self.open_output("src/text/text4.asm") as target:
+            self.get_template("templates/text4.asm").render(target, {"mitch_check": self.write_mitch_check})
 
     def randomize_text5(self):
-        with open_utf8("templates/text5.asm", "r") as src, open_utf8("src/text/text5.asm", "w") as target:
-            for i, line in enumerate(src):
-                target.write(line)
+        with self.open_output("src/text/text5.asm") as target:
+            self.get_template("templates/text5.asm").render(target)
 
     def randomize_text6(self):
-        with open_utf8("templates/text6.asm", "r") as src, open_utf8("src/text/text6.asm", "w") as target:
-            for i, line in enumerate(src):
-                target.write(line)
+        with self.open_output("src/text/text6.asm") as target:
+            self.get_template("templates/text6.asm").render(target)
+
+    def write_isaac_check(self, target, line):
+        npc = ""
+        if self.exclude_npcs:
+            if "Jennifer" in line:
+                npc = "Jennifer"
+            elif "Nicholas" in line:
+                npc = "Nicholas"
+            elif "Brandon" in line:
+                npc = "Brandon"
+        else:
+            if "Jennifer" in line:
+                npc = self.data["npc_names"]["Jennifer"]
+            elif "Nicholas" in line:
+                npc = self.data["npc_names"]["Nicholas"]
+            elif "Brandon" in line:
+                npc = self.data["npc_names"]["Brandon"]
+        target.write(self.text_line(line.format(npc)))
 
     def randomize_text7(self):
-        with open_utf8("templates/text7.asm", "r") as src, open_utf8("src/text/text7.asm", "w") as target:
-            for i, line in enumerate(src):
-                if "; ISAAC_CHECK:" in line:
-                    npc = ""
-                    if self.exclude_npcs:
-                        if "Jennifer" in line:
-                            npc = "Jennifer"
-                        elif "Nicholas" in line:
-                            npc = "Nicholas"
-                        elif "Brandon" in line:
-                            npc = "Brandon"
-                    else:
-                        if "Jennifer" in line:
-                            npc = self.data["npc_names"]["Jennifer"]
-                        elif "Nicholas" in line:
-                            npc = self.data["npc_names"]["Nicholas"]
-                        elif "Brandon" in line:
-                            npc = self.data["npc_names"]["Brandon"]
-                    target.write(line.format(npc))
-                else:
-                    target.write(line)
+        with self.open_output("src/text/text7.asm") as target:
+            self.get_template("templates/text7.asm").render(target, {"isaac_check": self.write_isaac_check})
 
     def randomize_text8(self):
-        with open_utf8("templates/text8.asm", "r") as src, open_utf8("src/text/text8.asm", "w") as target:
-            for i, line in enumerate(src):
-                target.write(line)
+        with self.open_output("src/text/text8.asm") as target:
+            self.get_template("templates/text8.asm").render(target)
 
     def randomize_text9(self):
-        with open_utf8("templates/text9.asm", "r") as src, open_utf8("src/text/text9.asm", "w") as target:
-            for i, line in enumerate(src):
-                target.write(line)
-
-
-seed = random.randint(0, 999999)
-if len(sys.argv) > 1:
-    seed = int(sys.argv[1])
-
-ptcg = PTCGRando()
-ptcg.load_data("data/data.json", "data/cards.json", "data/npc_names.json")
-ptcg.seed = seed
-ptcg.randomize_cards()
-ptcg.randomize_bank03()
-ptcg.randomize_bank04()
-ptcg.randomize_home()
-ptcg.randomize_decks()
-ptcg.randomize_text_offsets()
-ptcg.randomize_text2()
-ptcg.randomize_text3()
-ptcg.randomize_text4()
-ptcg.randomize_text5()
-ptcg.randomize_text6()
-ptcg.randomize_text7()
-ptcg.randomize_text8()
-ptcg.randomize_text9()
+        with self.open_output("src/text/text9.asm") as target:
+            self.get_template("templates/text9.asm").render(target)
+
+    def run_phase(self, phase):
+        with self.phase(phase):
+            getattr(self, phase)()
+
+    # Writes every randomized source file for self.seed
+    def randomize(self):
+        for phase in PTCGRando.PHASES:
+            self.run_phase(phase)
+
+    # Generates seeds one after the other, reusing the loaded data and templates
+    def generate_many(self, seeds, build=False, refs=None, cache=None, copy_rom=False):
+        for seed in seeds:
+            if build:
+                yield build_seed(self, seed, refs=refs, cache=cache, copy_rom=copy_rom)
+            else:
+                self.seed = seed
+                self.randomize()
+                yield True
 
 
 def is_tool(name):
@@ -874,28 +1798,760 @@ def is_tool(name):
     return which(name) is not None
 
 
-# Generates the .ips file using lipx and applies it to create the patched poketcg.gbc ROM
-if is_tool("make"):
-    make = subprocess.run(["make"], stdout=subprocess.PIPE, universal_newlines=True)
-    if make.returncode == 0:
-        lipx = subprocess.run(
-            [
-                "python",
-                "lipx.py",
-                "-c",
-                "baserom.gbc",
-                "poketcg.gbc",
-                "ptcgr_{:06d}.ips".format(seed),
-            ],
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
+# BUILD STEPS
+# make runs as an asyncio subprocess so one process can overlap several builds, lipx runs in process
+# on a worker thread. The output of a step is collected line by line and echoed as it arrives when
+# stream is set, a step still running after timeout seconds is killed along with its children.
+# Returns whether the step succeeded and its output.
+async def run_step(args, cwd=None, timeout=None, stream=False, prefix=""):
+    process = await asyncio.create_subprocess_exec(
+        *args, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, start_new_session=True
+    )
+    output = []
+
+    async def read():
+        async for line in process.stdout:
+            line = line.decode("utf8", "replace")
+            output.append(line)
+            if stream:
+                print(prefix + line, end="", flush=True)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(read(), process.wait()), timeout)
+    except asyncio.TimeoutError:
+        # make runs the assembler in child processes, kill the whole group
+        os.killpg(process.pid, signal.SIGKILL)
+        await process.wait()
+        output.append("{} timed out after {}s\n".format(args[0], timeout))
+        return False, "".join(output)
+
+    return process.returncode == 0, "".join(output)
+
+
+# Blocking form of run_step for callers outside an event loop
+def make_command(jobs=1):
+    return ["make"] if jobs <= 1 else ["make", "-j{}".format(jobs)]
+
+
+def run_build_step(args, cwd=None, timeout=None, stream=False, prefix=""):
+    return asyncio.run(run_step(args, cwd, timeout, stream, prefix))
+
+
+# baserom.gbc by real path, it doesn't change during a run
+base_roms = {}
+
+
+def read_base_rom(work_dir="."):
+    path = os.path.realpath(os.path.join(work_dir, "baserom.gbc"))
+    if path not in base_roms:
+        with open(path, "rb") as file:
+            base_roms[path] = file.read()
+    return base_roms[path]
+
+
+# Writes the .ips file diffing rom, the ROM assembled in work_dir when None, against baserom.gbc.
+# A copy of the patched ROM including the seed name is only written with copy_rom.
+def write_patch(seed, rom=None, work_dir=".", patch_dir=".", copy_rom=False):
+    if rom is None:
+        with open(os.path.join(work_dir, "poketcg.gbc"), "rb") as file:
+            rom = file.read()
+
+    patch = lipx.create_patch(read_base_rom(work_dir), rom)
+    with open(os.path.join(patch_dir, "ptcgr_{:06d}.ips".format(seed)), "wb") as file:
+        file.write(patch)
+
+    if copy_rom:
+        with open(os.path.join(patch_dir, "poketcg_{:06d}.gbc".format(seed)), "wb") as file:
+            file.write(rom)
+
+
+# Assembles the randomized sources and generates the .ips file with lipx
+async def build_patch_async(seed, work_dir=".", patch_dir=".", copy_rom=False, profiler=None, timeout=None, stream=False, jobs=1):
+    with profile_phase(profiler, "make"):
+        success, output = await run_step(make_command(jobs), work_dir, timeout, stream, "[{:06d} make] ".format(seed))
+    if not success:
+        if not stream:
+            print(output)
+        return False
+
+    with profile_phase(profiler, "lipx"):
+        try:
+            await asyncio.to_thread(write_patch, seed, None, work_dir, patch_dir, copy_rom)
+        except (OSError, lipx.IPSError) as error:
+            print("Cannot create the patch for seed {:06d}: {}".format(seed, error))
+            return False
+    print("Successfully compiled with seed: {:06d}".format(seed))
+
+    return True
+
+
+def build_patch(seed, work_dir=".", patch_dir=".", copy_rom=False, profiler=None, timeout=None, stream=False, jobs=1):
+    return asyncio.run(build_patch_async(seed, work_dir, patch_dir, copy_rom, profiler, timeout, stream, jobs))
+
+
+# Copies the cached patch of a seed to patch_dir, returns False on a miss. Only the patch is cached,
+# seeds wanting a copy of their ROM are built.
+def get_cached_patch(ptcg, seed, patch_dir, cache, copy_rom):
+    if cache is None or copy_rom:
+        return False
+
+    if not cache.get(ptcg.cache_key(seed), os.path.join(patch_dir, "ptcgr_{:06d}.ips".format(seed))):
+        return False
+    print("Cached patch for seed: {:06d}".format(seed))
+    return True
+
+
+# Stores the patch just built for a seed in the patch cache
+def put_cached_patch(ptcg, seed, patch_dir, cache):
+    patch_file = os.path.join(patch_dir, "ptcgr_{:06d}.ips".format(seed))
+    if cache is not None and os.path.exists(patch_file):
+        cache.put(ptcg.cache_key(seed), patch_file)
+
+
+# Randomizes and builds a single seed, going through the patch cache when one is given
+def build_seed(ptcg, seed, work_dir=".", patch_dir=".", refs=None, cache=None, copy_rom=False):
+    if get_cached_patch(ptcg, seed, patch_dir, cache, copy_rom):
+        return True
+
+    if refs is not None:
+        success = fast_build(ptcg, seed, refs, work_dir, patch_dir, copy_rom)
+    else:
+        ptcg.seed = seed
+        ptcg.randomize()
+        success = build_patch(
+            seed, work_dir, patch_dir, copy_rom, ptcg.profiler, ptcg.build_timeout, ptcg.stream_output, ptcg.make_jobs
         )
+
+    if success:
+        put_cached_patch(ptcg, seed, patch_dir, cache)
+
+    return success
+
+
+# build_seed for the event loop, without the --fast path
+async def build_seed_async(ptcg, seed, work_dir=".", patch_dir=".", cache=None, copy_rom=False):
+    if get_cached_patch(ptcg, seed, patch_dir, cache, copy_rom):
+        return True
+
+    ptcg.seed = seed
+    ptcg.randomize()
+    success = await build_patch_async(
+        seed, work_dir, patch_dir, copy_rom, ptcg.profiler, ptcg.build_timeout, ptcg.stream_output, ptcg.make_jobs
+    )
+
+    if success:
+        put_cached_patch(ptcg, seed, patch_dir, cache)
+
+    return success
+
+
+# On-disk store of generated patches keyed by PTCGRando.cache_key, least recently used ones are
+# evicted once the store grows past max_size bytes
+class PatchCache:
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".ips")
+
+    # Copies a cached patch to patch_file, returns False on a miss
+    def get(self, key, patch_file):
+        try:
+            shutil.copyfile(self.path(key), patch_file)
+        except FileNotFoundError:
+            return False
+
+        # Last access time is tracked with the mtime, another process may have evicted it since
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def put(self, key, patch_file):
+        tmp_file = self.path(key) + ".tmp{}".format(os.getpid())
+        shutil.copyfile(patch_file, tmp_file)
+        os.replace(tmp_file, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".ips"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        evict_lru(entries, self.max_size, PatchCache.remove)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Reference builds of the direct ROM patching mode, a directory per PTCGRando.reference_key. Least
+# recently used ones are evicted once the store grows past max_size bytes, like in PatchCache.
+class ReferenceStore:
+    def __init__(self, ref_root, max_size):
+        self.ref_root = ref_root
+        self.max_size = max_size
+        os.makedirs(ref_root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.ref_root, key)
+
+    # RomPatcher of a reference, None on a miss
+    def get(self, key):
+        try:
+            patcher = RomPatcher(self.path(key))
+        except FileNotFoundError:
+            return None
+
+        # Another process may have evicted it since
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        return patcher
+
+    # Saves the build in work_dir as a reference, returns False when it can't be used as one
+    def put(self, key, work_dir, fields, constants):
+        if not RomPatcher.save_reference(self.path(key), work_dir, fields, constants):
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.ref_root):
+            # Skip the references other processes are still saving
+            if ".tmp" in entry.name or not entry.is_dir():
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+                size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, size, entry.path))
+
+        evict_lru(entries, self.max_size, partial(shutil.rmtree, ignore_errors=True))
+
+
+# Direct ROM patching mode. Seeds whose sources only differ from an earlier build in their fields
+# (hp, retreat cost, weakness, resistance, sets and attacks of the cards, start_duel and
+# give_booster_packs arguments, starter deck lists, npc and starter deck names) reuse that build's
+# ROM and get those bytes written directly. Anything else changing the layout (the order of the
+# master checks, booster counts, starter decks that can't be padded) goes through make and becomes
+# the reference for its layout. References are also keyed on the build inputs, editing other
+# sources, the base ROM, the Makefile or the tools makes new ones.
+def fast_build(ptcg, seed, refs, work_dir=".", patch_dir=".", copy_rom=False):
+    if ptcg.constants is None:
+        ptcg.constants = AsmConstants()
+    constants = ptcg.constants
+
+    ptcg.seed = seed
+    ptcg.fields = []
+    ptcg.randomize()
+    fields = ptcg.fields
+    ptcg.fields = None
+
+    key = ptcg.reference_key()
+    rom = None
+    patcher = refs.get(key)
+    if patcher is not None:
+        with ptcg.phase("rom_patch"):
+            rom = patcher.patch(fields, constants)
+
+    if rom is None:
+        with ptcg.phase("make"):
+            success, output = run_build_step(
+                make_command(ptcg.make_jobs), work_dir, ptcg.build_timeout, ptcg.stream_output, "[{:06d} make] ".format(seed)
+            )
+        if not success:
+            if not ptcg.stream_output:
+                print(output)
+            return False
+
+        if patcher is None and not refs.put(key, work_dir, fields, constants):
+            print("Field offsets don't match the assembled ROM, not saving a reference")
+
+    with ptcg.phase("lipx"):
+        try:
+            write_patch(seed, rom, work_dir, patch_dir, copy_rom)
+        except (OSError, lipx.IPSError) as error:
+            print("Cannot create the patch for seed {:06d}: {}".format(seed, error))
+            return False
+
+    if rom is None:
         print("Successfully compiled with seed: {:06d}".format(seed))
+    else:
+        print("Successfully patched with seed: {:06d}".format(seed))
 
-        # Make a copy of the patched ROM including the time and seed name
-        shutil.copyfile("poketcg.gbc", "poketcg_{:06d}.gbc".format(seed))
+    return True
 
-        sys.exit(0)
+
+# SEED FARM
+# Each worker process builds in its own tree under the farm directory. Sources, tools and the
+# objects that never change between seeds are symlinks to the repository, only the randomized
+# sources and the objects assembled from them are real files.
+FARM_LINKS = ["Makefile", "baserom.gbc", "tools"]
+FARM_SHARED_DIRS = ["src/gfx", "src/audio"]
+FARM_REBUILT_OBJECTS = ["src/main.o", "src/text.o"]
+
+# Default make jobs of a single seed build, one per object a seed rebuilds
+MAKE_JOBS = len(FARM_REBUILT_OBJECTS)
+
+farm_ptcg = None
+farm_work_dir = None
+farm_slot_lock = None
+
+
+def make_work_tree(work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+
+    for name in FARM_LINKS:
+        link = os.path.join(work_dir, name)
+        if os.path.exists(name) and not os.path.lexists(link):
+            os.symlink(os.path.abspath(name), link)
+
+    for root, dirs, files in os.walk("src"):
+        os.makedirs(os.path.join(work_dir, root), exist_ok=True)
+
+        for name in list(dirs):
+            path = os.path.join(root, name)
+            if path in FARM_SHARED_DIRS:
+                dirs.remove(name)
+                link = os.path.join(work_dir, path)
+                if not os.path.lexists(link):
+                    os.symlink(os.path.abspath(path), link)
+
+        for name in files:
+            path = os.path.join(root, name)
+            link = os.path.join(work_dir, path)
+            if path in PTCGRando.OUTPUTS or path in FARM_REBUILT_OBJECTS or os.path.lexists(link):
+                continue
+            os.symlink(os.path.abspath(path), link)
+
+
+# Takes the first free slot of farm_dir and returns its lock and {prefix}_N work tree, so runs
+# reuse the same trees. A slot is held by a lock on {prefix}_N.lock until the lock is closed or the
+# process exits, so concurrent runs never build in the same tree.
+def lock_slot(farm_dir, prefix):
+    os.makedirs(farm_dir, exist_ok=True)
+    slot = 0
+    while True:
+        lock = open(os.path.join(farm_dir, "{}_{}.lock".format(prefix, slot)), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            lock.close()
+            slot += 1
+
+    work_dir = os.path.join(farm_dir, "{}_{}".format(prefix, slot))
+    make_work_tree(work_dir)
+    return lock, work_dir
+
+
+# Each worker builds in its own worker_N slot, held for the lifetime of the worker
+def farm_init(farm_dir, template_cache, make_jobs=1):
+    global farm_ptcg, farm_work_dir, farm_slot_lock
+
+    farm_slot_lock, farm_work_dir = lock_slot(farm_dir, "worker")
+
+    farm_ptcg = PTCGRando()
+    farm_ptcg.load_data("data/data.json", "data/cards.json", "data/npc_names.json")
+    farm_ptcg.load_templates(template_cache)
+    farm_ptcg.output_dir = farm_work_dir
+    farm_ptcg.make_jobs = make_jobs
+
+
+def farm_seed(seed, patch_dir, refs, cache):
+    return build_seed(farm_ptcg, seed, farm_work_dir, patch_dir, refs, cache, copy_rom=False)
+
+
+# Reference build so the tools and shared objects exist before workers link to them
+def make_reference(timeout=None, stream=False):
+    success, output = run_build_step(["make"], None, timeout, stream, "[make] ")
+    if not success and not stream:
+        print(output)
+    return success
+
+
+# Builds seeds in parallel, one isolated build tree per worker process
+def run_farm(seeds, jobs, farm_dir="farm", patch_dir="patches", refs=None, cache=None, template_cache=None):
+    os.makedirs(patch_dir, exist_ok=True)
+
+    if not make_reference():
+        return False
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=farm_init, initargs=(farm_dir, template_cache)) as executor:
+        count = len(seeds)
+        results = executor.map(farm_seed, seeds, [patch_dir] * count, [refs] * count, [cache] * count)
+        return all(list(results))
+
+
+# Builds seeds from one process with up to `builds` of them in flight. Each build slot locks its own
+# build_N work tree under farm_dir like the farm workers do and has its own PTCGRando, seeds are
+# randomized on the event loop between the make and patch steps of the other slots.
+async def build_seeds_async(seeds, builds, farm_dir="farm", patch_dir="patches", cache=None, template_cache=None, timeout=None, stream=False):
+    queue = asyncio.Queue()
+    for seed in seeds:
+        queue.put_nowait(seed)
+    results = []
+
+    async def build_slot():
+        lock, work_dir = lock_slot(farm_dir, "build")
+
+        ptcg = PTCGRando()
+        ptcg.load_data("data/data.json", "data/cards.json", "data/npc_names.json")
+        ptcg.load_templates(template_cache)
+        ptcg.output_dir = work_dir
+        ptcg.build_timeout = timeout
+        ptcg.stream_output = stream
+
+        with lock:
+            while not queue.empty():
+                seed = queue.get_nowait()
+                results.append(await build_seed_async(ptcg, seed, work_dir, patch_dir, cache, copy_rom=False))
+
+    await asyncio.gather(*[build_slot() for _ in range(builds)])
+    return all(results)
+
+
+def run_builds(seeds, builds, farm_dir="farm", patch_dir="patches", cache=None, template_cache=None, timeout=None, stream=False):
+    os.makedirs(patch_dir, exist_ok=True)
+
+    if not make_reference(timeout, stream):
+        return False
+
+    return asyncio.run(build_seeds_async(seeds, builds, farm_dir, patch_dir, cache, template_cache, timeout, stream))
+
+
+# SEED SERVICE
+# `rando.py serve` keeps farm workers with their data and templates loaded and builds the seeds
+# posted to it:
+#   POST /jobs                 {"seed": 123, "options": {"exclude_npcs": true}}, 202 with the job id
+#   POST /jobs?wait=1          same, answering with the .ips once built
+#   GET  /jobs/<id>            job status: queued, running, done or failed
+#   GET  /jobs/<id>/patch      the .ips of a done job
+# Jobs past the queue size are refused with 503 until workers catch up.
+def serve_seed(seed, options, patch_dir, refs, cache):
+    defaults = PTCGRando()
+    for option in PTCGRando.OPTIONS:
+        setattr(farm_ptcg, option, options.get(option, getattr(defaults, option)))
+
+    os.makedirs(patch_dir, exist_ok=True)
+    return build_seed(farm_ptcg, seed, farm_work_dir, patch_dir, refs, cache, copy_rom=False)
+
+
+class SeedJob:
+    def __init__(self, seed, options, patch_dir):
+        self.id = uuid.uuid4().hex
+        self.seed = seed
+        self.options = options
+        self.patch_dir = patch_dir
+        self.future = None
+
+    def status(self):
+        if not self.future.done():
+            return "running" if self.future.running() else "queued"
+        if self.future.cancelled() or self.future.exception() is not None or not self.future.result():
+            return "failed"
+        return "done"
+
+    def patch_file(self):
+        return os.path.join(self.patch_dir, "ptcgr_{:06d}.ips".format(self.seed))
+
+    def describe(self):
+        return {"id": self.id, "seed": self.seed, "options": self.options, "status": self.status()}
+
+
+class SeedService:
+    def __init__(self, executor, queue_size, patch_dir, refs=None, cache=None, keep_jobs=1000):
+        self.executor = executor
+        self.queue_size = queue_size
+        self.patch_dir = patch_dir
+        self.refs = refs
+        self.cache = cache
+        self.keep_jobs = keep_jobs
+
+        # Jobs by id in submission order, guarded by the lock since requests are served by threads
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    # Options must be PTCGRando.OPTIONS with the type of their default value
+    @staticmethod
+    def check_options(options):
+        defaults = PTCGRando()
+        for option, value in options.items():
+            if option not in PTCGRando.OPTIONS:
+                return "unknown option: {}".format(option)
+            if type(value) is not type(getattr(defaults, option)):
+                return "option {} must be a {}".format(option, type(getattr(defaults, option)).__name__)
+        return None
+
+    # Queues a job, None when the queue is full
+    def submit(self, seed, options):
+        with self.lock:
+            pending = sum(1 for job in self.jobs.values() if not job.future.done())
+            if pending >= self.queue_size:
+                return None
+
+            job = SeedJob(seed, options, None)
+            job.patch_dir = os.path.join(self.patch_dir, job.id)
+            job.future = self.executor.submit(serve_seed, seed, options, job.patch_dir, self.refs, self.cache)
+            self.jobs[job.id] = job
+            self.evict()
+            return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    # Forgets the oldest finished jobs past keep_jobs along with their patches
+    def evict(self):
+        finished = [job for job in self.jobs.values() if job.future.done()]
+        for job in finished[: max(len(self.jobs) - self.keep_jobs, 0)]:
+            del self.jobs[job.id]
+            shutil.rmtree(job.patch_dir, ignore_errors=True)
+
+
+class SeedRequestHandler(http.server.BaseHTTPRequestHandler):
+    def send_json(self, code, value, headers={}):
+        body = json.dumps(value).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, header in headers.items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_patch(self, job):
+        with open(job.patch_file(), "rb") as file:
+            patch = file.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(patch)))
+        self.send_header("Content-Disposition", 'attachment; filename="ptcgr_{:06d}.ips"'.format(job.seed))
+        self.end_headers()
+        self.wfile.write(patch)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            seed = request.get("seed", random.randint(0, 999999))
+            options = request.get("options", {})
+        except (ValueError, AttributeError):
+            self.send_json(400, {"error": "expected a JSON object"})
+            return
+
+        if type(seed) is not int or not 0 <= seed <= 999999:
+            self.send_json(400, {"error": "seed must be an integer from 0 to 999999"})
+            return
+        error = SeedService.check_options(options) if isinstance(options, dict) else "options must be an object"
+        if error is not None:
+            self.send_json(400, {"error": error})
+            return
+
+        job = self.server.service.submit(seed, options)
+        if job is None:
+            self.send_json(503, {"error": "queue is full"}, {"Retry-After": "1"})
+            return
+
+        if urllib.parse.parse_qs(url.query).get("wait", ["0"])[0] in ("1", "true"):
+            concurrent.futures.wait([job.future])
+            if job.status() == "done":
+                self.send_patch(job)
+            else:
+                self.send_json(500, job.describe())
+            return
+
+        self.send_json(202, job.describe(), {"Location": "/jobs/" + job.id})
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        if len(parts) not in [2, 3] or parts[0] != "jobs" or (len(parts) == 3 and parts[2] != "patch"):
+            self.send_json(404, {"error": "not found"})
+            return
+
+        job = self.server.service.get(parts[1])
+        if job is None:
+            self.send_json(404, {"error": "unknown job"})
+        elif len(parts) == 2:
+            self.send_json(200, job.describe())
+        elif job.status() == "done":
+            self.send_patch(job)
+        else:
+            self.send_json(409, job.describe())
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog="rando.py serve", description="Pokemon TCG randomizer seed service")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes building seeds")
+    parser.add_argument("--make-jobs", type=int, default=MAKE_JOBS, help="make jobs of a worker, a seed rebuilds main.o and text.o")
+    parser.add_argument("--queue-size", type=int, default=64, help="queued and running jobs accepted at once")
+    parser.add_argument("--keep-jobs", type=int, default=1000, help="finished jobs kept for polling")
+    parser.add_argument("--farm-dir", default="farm", help="directory holding the worker build trees")
+    parser.add_argument("--patch-dir", default="patches", help="directory holding the patches of the jobs")
+    parser.add_argument("--fast", action="store_true", help="patch fixed-size fields into a reference ROM when possible")
+    parser.add_argument("--ref-dir", default="refs", help="directory holding the reference builds used by --fast")
+    parser.add_argument("--ref-size", type=int, default=256, help="reference builds size limit in MB")
+    parser.add_argument("--template-cache", default=".template_cache", help="file caching the compiled templates")
+    parser.add_argument("--cache-dir", help="reuse patches generated with the same seed, options and inputs")
+    parser.add_argument("--cache-size", type=int, default=1024, help="patch cache size limit in MB")
+    args = parser.parse_args(argv)
+
+    if not is_tool("make"):
+        print("serve needs make and the RGBDS tools on PATH")
+        sys.exit(1)
+    if not make_reference():
+        sys.exit(1)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = PatchCache(os.path.abspath(args.cache_dir), args.cache_size * 1024 * 1024)
+    refs = None
+    if args.fast:
+        refs = ReferenceStore(os.path.abspath(args.ref_dir), args.ref_size * 1024 * 1024)
+
+    with concurrent.futures.ProcessPoolExecutor(
+        args.jobs, initializer=farm_init, initargs=(args.farm_dir, args.template_cache, args.make_jobs)
+    ) as executor:
+        service = SeedService(executor, args.queue_size, os.path.abspath(args.patch_dir), refs, cache, args.keep_jobs)
+        server = http.server.ThreadingHTTPServer((args.host, args.port), SeedRequestHandler)
+        server.service = service
+
+        print("Serving seeds on http://{}:{}".format(args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        executor.shutdown(cancel_futures=True)
+
+
+# Parses a seed list such as "1000-1999" or "1,5,10-20"
+def parse_seeds(text):
+    seeds = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            seeds.extend(range(int(first), int(last) + 1))
+        else:
+            seeds.append(int(part))
+    return seeds
+
+
+def main():
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description="Pokemon TCG randomizer")
+    parser.add_argument("seed", nargs="?", type=int, help="seed to generate, random if omitted")
+    parser.add_argument("--seeds", type=parse_seeds, help="generate many seeds in one run, e.g. 1000-1999")
+    parser.add_argument("--farm", action="store_true", help="build seeds in parallel worker build trees")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes used by --farm")
+    parser.add_argument("--farm-dir", default="farm", help="directory holding the worker build trees")
+    parser.add_argument("--patch-dir", default="patches", help="directory collecting the .ips files built by --farm")
+    parser.add_argument("--fast", action="store_true", help="patch fixed-size fields into a reference ROM when possible")
+    parser.add_argument("--ref-dir", default="refs", help="directory holding the reference builds used by --fast")
+    parser.add_argument("--ref-size", type=int, default=256, help="reference builds size limit in MB")
+    parser.add_argument("--template-cache", default=".template_cache", help="file caching the compiled templates")
+    parser.add_argument("--cache-dir", help="reuse patches generated with the same seed, options and inputs")
+    parser.add_argument("--cache-size", type=int, default=1024, help="patch cache size limit in MB")
+    parser.add_argument("--copy-rom", action="store_true", help="also write the patched ROM next to the .ips file")
+    parser.add_argument("--builds", type=int, default=1, help="concurrent builds driven by this process with asyncio")
+    parser.add_argument("--make-jobs", type=int, default=MAKE_JOBS, help="make jobs of a single build, a seed rebuilds main.o and text.o")
+    parser.add_argument("--build-timeout", type=float, help="seconds make may run before being killed")
+    parser.add_argument("--stream-output", action="store_true", help="echo make output as it arrives")
+    parser.add_argument("--profile", metavar="REPORT", help="time each phase and write a JSON report")
+    parser.add_argument("--profile-phase", help="also run this phase under cProfile, e.g. randomize_cards")
+    parser.add_argument("--profile-stats", default="profile.pstats", help="cProfile stats file for --profile-phase")
+    args = parser.parse_args()
+
+    if args.seeds is not None:
+        seeds = args.seeds
+    elif args.seed is not None:
+        seeds = [args.seed]
     else:
-        print(make.stdout)
+        seeds = [random.randint(0, 999999)]
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = PatchCache(os.path.abspath(args.cache_dir), args.cache_size * 1024 * 1024)
+    refs = None
+    if args.fast:
+        refs = ReferenceStore(os.path.abspath(args.ref_dir), args.ref_size * 1024 * 1024)
+
+    # The profiler only sees this process
+    if args.profile is not None and (args.farm or args.builds > 1):
+        parser.error("--profile doesn't support --farm or --builds")
+
+    if args.builds > 1:
+        if not is_tool("make"):
+            parser.error("--builds needs make and the RGBDS tools on PATH")
+        if args.fast:
+            parser.error("--builds doesn't support --fast, use --farm")
+        if not run_builds(seeds, args.builds, args.farm_dir, args.patch_dir, cache, args.template_cache, args.build_timeout, args.stream_output):
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.farm:
+        if not is_tool("make"):
+            parser.error("--farm needs make and the RGBDS tools on PATH")
+        if not run_farm(seeds, args.jobs, args.farm_dir, args.patch_dir, refs, cache, args.template_cache):
+            sys.exit(1)
+        sys.exit(0)
+
+    ptcg = PTCGRando()
+    ptcg.build_timeout = args.build_timeout
+    ptcg.stream_output = args.stream_output
+    ptcg.make_jobs = args.make_jobs
+    if args.profile is not None:
+        ptcg.profiler = Profiler(args.profile_phase)
+        ptcg.profiler.install()
+
+    with ptcg.phase("load_data"):
+        ptcg.load_data("data/data.json", "data/cards.json", "data/npc_names.json")
+    with ptcg.phase("load_templates"):
+        ptcg.load_templates(args.template_cache)
+
+    # Every seed is generated even when an earlier one fails
+    results = list(ptcg.generate_many(seeds, build=is_tool("make"), refs=refs, cache=cache, copy_rom=args.copy_rom))
+    failed = [seed for seed, result in zip(seeds, results) if not result]
+    if failed:
+        print("Failed seeds: {}".format(", ".join(str(seed) for seed in failed)))
+    success = not failed
+
+    if ptcg.profiler is not None:
+        ptcg.profiler.uninstall()
+        report = ptcg.profiler.report()
+        report["seeds"] = len(seeds)
+        with open_utf8(args.profile, "w") as file:
+            json.dump(report, file, indent=2)
+        ptcg.profiler.dump_stats(args.profile_stats)
+
+    if not success:
         sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import random
+from collections import Counter
+
+import pytest
+
+import lipx
+from rando import CapacitySampler, NoiseStream, noise3d
+
+
+def records(patch):
+    return list(lipx.IPSReader(patch))
+
+
+def apply(original, patch):
+    return lipx.apply_patch(original, patch, check_sha1=False)
+
+
+def test_ips_round_trip_with_rle_runs():
+    rng = random.Random(1)
+    original = bytes(rng.randrange(256) for _ in range(0x20000))
+    modified = bytearray(original)
+    modified[0x100:0x1100] = b"\xaa" * 0x1000
+    modified[0x8000:0x8010] = bytes(range(16))
+    for offset in rng.sample(range(0x10000, 0x20000), 50):
+        modified[offset] ^= 0xFF
+    modified[-0x200:] = b"\x00" * 0x200
+
+    patch = lipx.create_patch(original, bytes(modified))
+
+    assert any(len(record) == 3 for record in records(patch))
+    assert apply(original, patch) == modified
+
+
+def test_ips_round_trip_of_identical_files():
+    original = bytes(range(256)) * 16
+    patch = lipx.create_patch(original, original)
+
+    assert records(patch) == []
+    assert apply(original, patch) == original
+
+
+@pytest.mark.parametrize("run", [1, 0x100])
+def test_ips_record_at_eof_offset(run):
+    original = bytes(lipx.EOF_OFFSET + 0x400)
+    modified = bytearray(original)
+    modified[lipx.EOF_OFFSET:lipx.EOF_OFFSET + run] = b"\x11" * run
+
+    patch = lipx.create_patch(original, bytes(modified))
+
+    assert all(record[0] != lipx.EOF_OFFSET for record in records(patch))
+    assert apply(original, patch) == modified
+
+
+def test_ips_writer_splits_records_around_eof_offset():
+    data = bytes(random.Random(2).randrange(256) for _ in range(lipx.RECORD_LIMIT + 0x10))
+    offset = lipx.EOF_OFFSET - lipx.RECORD_LIMIT
+    patch = bytearray()
+    with lipx.IPSWriter(patch) as writer:
+        writer.write(offset, data)
+
+    assert [record[0] for record in records(patch)] == [offset, lipx.EOF_OFFSET - 1]
+
+    original = bytes(lipx.EOF_OFFSET + 0x100)
+    assert apply(original, patch)[offset:offset + len(data)] == data
+
+    with pytest.raises(lipx.IPSError):
+        lipx.IPSWriter(bytearray()).write(lipx.EOF_OFFSET, b"\x00")
+
+
+def test_bps_round_trip():
+    rng = random.Random(3)
+    original = bytes(rng.randrange(256) for _ in range(0x8000))
+    # Moved blocks, a fill, new data and a longer target
+    modified = original[0x4000:0x6000] + original[:0x4000] + b"\x33" * 0x800 + original[0x6000:] + b"new data"
+
+    patch = lipx.create_bps_patch(original, modified)
+
+    assert patch[:4] == lipx.BPS.BPS_ASCII
+    assert len(patch) < len(modified) // 4
+    assert apply(original, patch) == modified
+
+
+def test_bps_rejects_wrong_source():
+    original = bytes(range(256)) * 64
+    modified = original[::-1]
+    patch = lipx.create_bps_patch(original, modified)
+
+    with pytest.raises(lipx.BPSError):
+        apply(original[1:] + b"\x00", patch)
+
+
+def test_compose_matches_sequential_apply():
+    rng = random.Random(4)
+    original = bytes(rng.randrange(256) for _ in range(0x10000))
+    versions = [original]
+    for _ in range(4):
+        modified = bytearray(versions[-1])
+        for _ in range(20):
+            offset = rng.randrange(len(modified) - 0x100)
+            if rng.random() < 0.5:
+                modified[offset:offset + 0x80] = bytes([rng.randrange(256)]) * 0x80
+            else:
+                modified[offset:offset + 8] = bytes(rng.randrange(256) for _ in range(8))
+        versions.append(bytes(modified))
+    patches = [lipx.create_patch(a, b) for a, b in zip(versions, versions[1:])]
+
+    sequential = original
+    for patch in patches:
+        sequential = apply(sequential, patch)
+
+    assert sequential == versions[-1]
+    assert apply(original, lipx.compose_patches(patches)) == sequential
+    assert lipx.apply_patches(original, patches, check_sha1=False) == sequential
+
+
+def make_sampler(limits, counts=None):
+    cards = [{"constant": "CARD_{}".format(i), "limit": limit} for i, limit in enumerate(limits)]
+    return cards, CapacitySampler(cards, Counter(counts or {}))
+
+
+def test_capacity_sampler_distribution():
+    cards, sampler = make_sampler([4, 0, 1, 3, 4, 2], {"CARD_0": 1, "CARD_5": 5})
+    capacity = [3, 0, 1, 3, 4, 0]
+
+    assert sampler.total() == sum(capacity)
+    drawn = Counter(sampler.draw(n)["constant"] for n in range(sampler.total()))
+    assert drawn == Counter({card["constant"]: c for card, c in zip(cards, capacity) if c})
+
+    sampler.take(cards[3])
+    sampler.take(cards[3])
+    capacity[3] -= 2
+    drawn = Counter(sampler.draw(n)["constant"] for n in range(sampler.total()))
+    assert drawn == Counter({card["constant"]: c for card, c in zip(cards, capacity) if c})
+
+
+def test_capacity_sampler_never_exceeds_limits():
+    limits = [random.Random(5).randrange(5) for _ in range(100)]
+    cards, sampler = make_sampler(limits)
+    stream = NoiseStream(0, 1, seed=6)
+    counts = Counter()
+
+    while sampler.total():
+        card = sampler.draw(stream.next())
+        counts[card["constant"]] += 1
+        assert counts[card["constant"]] <= card["limit"]
+        sampler.take(card)
+
+    assert counts == Counter({card["constant"]: card["limit"] for card in cards if card["limit"]})
+
+    # Cards without capacity left or from outside the sampler are ignored
+    sampler.take(cards[0])
+    sampler.take({"constant": "OTHER", "limit": 4})
+    assert sampler.total() == 0 and min(sampler.capacity) == 0
+
+
+def test_noise_stream():
+    stream = NoiseStream(3, 4, seed=7)
+    assert stream.take(10) == [noise3d(3, 4, z, 7) for z in range(10)]
+    assert stream.next() == noise3d(3, 4, 10, 7)
+
+    l = list(range(50))
+    NoiseStream(1, 2).shuffle(l)
+    copy = list(range(50))
+    NoiseStream(1, 2).shuffle(copy)
+    assert l == copy and sorted(l) == list(range(50)) and l != list(range(50))